@@ -0,0 +1,112 @@
+import time
+from collections import Counter
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionControl:
+    # Handlers run synchronously on the event loop, so requests don't queue
+    # in front of them but in the loop itself, as connections whose bodies
+    # are yet to be read and parsed, or as callbacks waiting their turn.
+    # Requests are shed with Overloaded when the loop `monitor` says it is
+    # more than `max_wait` seconds behind, when they spent longer than that
+    # getting from the app to their handler, or when they arrive with
+    # `limit` others in flight, as counted by AdmissionMiddleware. On top of
+    # that every user gets a token bucket of `burst` requests refilled at
+    # `rate` per second. Shed requests are answered right away instead of
+    # timing out on the platform side.
+    def __init__(self, limit=256, max_wait=1.0, rate=5.0, burst=10,
+                 max_users=100000, monitor=None):
+        self.monitor = monitor
+        self.limit = limit
+        self.max_wait = max_wait
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.max_delay = 0.0
+        # user_id -> (tokens, time of the last refill)
+        self.buckets = {}
+        self.counters = Counter()
+
+    def arrive(self):
+        # whether the new arrival fits
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return self.in_flight <= self.limit
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def take_token(self, user_id):
+        now = time.monotonic()
+        tokens, last = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[user_id] = tokens, now
+            return False
+        self.buckets[user_id] = tokens - 1, now
+        if len(self.buckets) > self.max_users:
+            self.prune(now)
+        return True
+
+    def prune(self, now):
+        # buckets that would have refilled completely are the same as none
+        full = self.burst / self.rate
+        for user_id, (tokens, last) in list(self.buckets.items()):
+            if now - last >= full:
+                del self.buckets[user_id]
+
+    def admit(self, user_id, state):
+        # `state` is what AdmissionMiddleware noted about the request
+        if not state.get('fits', True):
+            self.counters['shed_in_flight'] += 1
+            raise Overloaded
+        if self.monitor is not None and self.monitor.current_lag() > self.max_wait:
+            self.counters['shed_loop_lag'] += 1
+            raise Overloaded
+        if 'arrived' in state:
+            delay = time.monotonic() - state['arrived']
+            self.max_delay = max(self.max_delay, delay)
+            if delay > self.max_wait:
+                self.counters['shed_delay'] += 1
+                raise Overloaded
+        if not self.take_token(user_id):
+            self.counters['shed_rate_limited'] += 1
+            raise Overloaded
+        self.counters['admitted'] += 1
+
+    def stats(self):
+        ret = {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'max_delay_ms': round(1000 * self.max_delay, 3),
+            **self.counters,
+        }
+        self.max_in_flight = self.in_flight
+        self.max_delay = 0.0
+        return ret
+
+
+class AdmissionMiddleware:
+    # Counts the requests to `paths` from the moment they reach the app, and
+    # leaves in the ASGI scope's state whether each one fit and when it came.
+    def __init__(self, app, admission, paths):
+        self.app = app
+        self.admission = admission
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] not in self.paths:
+            return await self.app(scope, receive, send)
+        state = scope.setdefault('state', {})
+        state['arrived'] = time.monotonic()
+        state['fits'] = self.admission.arrive()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.leave()
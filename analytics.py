@@ -0,0 +1,105 @@
+import os
+import glob
+import gzip
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class Analytics:
+    # Events recorded on the request path go into a bounded queue, which is
+    # all a request pays for; when it's full the oldest event makes room. A
+    # task drains it every `flush_interval` seconds and a thread writes each
+    # batch as one gzip member of JSON lines to the current segment, so a
+    # crash loses at most the batch being written. A segment is closed once
+    # it reaches `segment_size` bytes, and only the newest `keep` segments
+    # are kept, all of them with `keep=0`.
+    def __init__(self, directory, queue_size=10000, flush_interval=1.0,
+                 segment_size=16 * 2**20, keep=0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.keep = keep
+
+        self.queue = deque(maxlen=queue_size)
+        self.counters = Counter()
+        # one writer at a time: a write already running in a thread goes on
+        # after the task that started it is cancelled
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.segment = self.segment_number(segments[-1]) + 1 if segments else 0
+
+    def segment_path(self, n):
+        return os.path.join(self.directory, f'events-{n:06}.jsonl.gz')
+
+    def segment_number(self, path):
+        return int(os.path.basename(path)[len('events-'):-len('.jsonl.gz')])
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'events-*.jsonl.gz')))
+
+    def record(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.counters['dropped'] += 1
+        self.queue.append(event)
+        self.counters['recorded'] += 1
+
+    def write(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        # runs in a thread; the deque can be appended to meanwhile
+        batch = []
+        while self.queue:
+            batch.append(json.dumps(self.queue.popleft(), ensure_ascii=False))
+        if not batch:
+            return
+        data = gzip.compress(('\n'.join(batch) + '\n').encode(), compresslevel=6)
+        path = self.segment_path(self.segment)
+        with open(path, 'ab') as f:
+            f.write(data)
+            size = f.tell()
+        self.counters['written'] += len(batch)
+        self.counters['batches'] += 1
+        if size >= self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        self.segment += 1
+        self.counters['segments'] += 1
+        if self.keep:
+            for path in self.segments()[:-self.keep]:
+                os.remove(path)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.write)
+            except OSError:
+                self.counters['write_errors'] += 1
+                logger.exception('writing analytics events')
+                continue
+            logger.debug(
+                f'analytics written in {1000 * (time.perf_counter() - started):.2f} ms')
+
+    def close(self):
+        self.write()
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'queue_size': self.queue.maxlen,
+            'segment': self.segment,
+            **self.counters,
+        }
@@ -0,0 +1,205 @@
+from content import packs
+from statemachine import StateMachine, EndSession, countable, to_tts
+
+
+CARD_VALUES = (2, 3, 4, 6, 7, 8, 9, 10, 11)
+
+
+class Card:
+    __slots__ = ('suit', 'number', 'value', 'value_index', 'text', 'tts', 'markup')
+
+    TTS_NUMBERS = {
+        6: 'шестёрка',
+        7: 'семёрка',
+        8: 'восьмёрка',
+        9: 'девятка',
+        10: 'десятка',
+        'J': 'валет',
+        'Q': 'дама',
+        'K': 'король',
+        'A': 'туз',
+    }
+
+    TTS_SUITS = {
+        '♠️': 'пик',
+        '♦️': 'бубен',
+        '♣️': 'крестей',
+        '♥️': 'червей'
+    }
+
+    VALUES = {
+        'J': 2,
+        'Q': 3,
+        'K': 4,
+        'A': 11
+    }
+
+    _interned = {}
+
+    def __new__(cls, suit, number):
+        # cards are immutable, so every deck shares the same objects
+        try:
+            return cls._interned[suit, number]
+        except KeyError:
+            pass
+        self = super().__new__(cls)
+        self.suit = suit
+        self.number = number
+        self.value = number if isinstance(number, int) else cls.VALUES[number]
+        self.value_index = CARD_VALUES.index(self.value)
+        self.text = f'{number}{suit}'
+        self.tts = f'{cls.TTS_NUMBERS[number]} {cls.TTS_SUITS[suit]}'
+        self.markup = f'{{{self.text}}}{{{self.tts}}}'
+        cls._interned[suit, number] = self
+        return self
+
+    def __repr__(self):
+        return self.markup
+
+    def __reduce__(self):
+        return Card, (self.suit, self.number)
+
+
+BUST = 22
+
+
+def win_chances(counts, dealer, value, memo):
+    # (chance to win by standing, chance to win by taking one more card)
+    # with `value` in hand, while the dealer holds `dealer` and is about to
+    # draw from a deck with `counts[k]` cards worth `CARD_VALUES[k]`. Which
+    # card of a shuffled deck goes to whom doesn't change the odds, so the
+    # player's extra card is taken as the one after the dealer's last, and a
+    # single search over the dealer's draws gives both chances. Only the
+    # composition of the deck matters, not the order of the cards.
+    key = counts, dealer
+    ret = memo.get(key)
+    if ret is not None:
+        return ret
+    total = sum(counts)
+    if dealer > 17 or not total:
+        stand = float(dealer >= BUST or dealer < value)
+        hit = 0.0
+        for k, n in enumerate(counts):
+            new_value = value + CARD_VALUES[k]
+            if n and new_value <= 21 and (
+                    new_value == 21 or dealer >= BUST or dealer < new_value):
+                hit += n
+        ret = stand, hit / total if total else stand
+    else:
+        stand = hit = 0.0
+        for k, n in enumerate(counts):
+            if not n:
+                continue
+            rest = counts[:k] + (n - 1,) + counts[k+1:]
+            s, h = win_chances(rest, dealer + CARD_VALUES[k], value, memo)
+            stand += s * n
+            hit += h * n
+        ret = stand / total, hit / total
+    memo[key] = ret
+    return ret
+
+
+class Game21(StateMachine):
+    similar = {
+        'ещё': ['еще'],
+    }
+
+    # the texts are in content/blackjack.json
+    PACK = 'blackjack'
+    # the texts it needs, with the values they're filled in with
+    TEXTS = {
+        'start': ('card', 'value'),
+        'twenty_one': ('card',),
+        'bust': ('card', 'points'),
+        'picked': ('card', 'hand', 'value'),
+        'chances': ('stand', 'hit'),
+        'won': ('hand', 'value'),
+        'lost': ('hand', 'value'),
+    }
+
+    DECK = tuple(
+        Card(suit, number)
+        for suit in ['♠️', '♦️', '♣️', '♥️']
+        for number in list(range(6, 11)) + ['J', 'Q', 'K', 'A']
+    )
+
+    __slots__ = ('deck', 'hand')
+
+    def __init__(self, rng=None):
+        super().__init__(rng)
+        # cards are kept as indices into DECK
+        self.deck = bytearray(range(len(self.DECK)))
+        self.rng.shuffle(self.deck)
+        self.hand = bytearray()
+
+    def get_card(self):
+        k = self.deck.pop()
+        self.hand.append(k)
+        return self.DECK[k]
+
+    def hand_value(self, hand=None):
+        if hand is None:
+            hand = self.hand
+        return sum(self.DECK[k].value for k in hand)
+
+    def hand_str(self, hand=None):
+        if hand is None:
+            hand = self.hand
+        return " ".join(self.DECK[k].markup for k in hand)
+
+    def hand_texts(self, hand=None):
+        # (text, tts) of the hand, to fill a text in with
+        text = self.hand_str(hand)
+        return text, to_tts(text)
+
+    def value_counts(self):
+        counts = [0] * len(CARD_VALUES)
+        for k in self.deck:
+            counts[self.DECK[k].value_index] += 1
+        return tuple(counts)
+
+    def win_chances(self, value, counts):
+        return win_chances(counts, 0, value, {})
+
+    def start(self):
+        self.state = ''
+        card = self.get_card()
+        return packs.get(self.PACK).text(
+            'start', card=(card.markup, card.tts), value=str(self.hand_value()))
+
+    @StateMachine.input({'ещё'})
+    def pick(self):
+        assert self.hand_value() < 21
+        pack = packs.get(self.PACK)
+        card = self.get_card()
+        card = card.markup, card.tts
+        value = self.hand_value()
+        if value == 21:
+            raise EndSession(pack.text('twenty_one', card=card))
+        elif value > 21:
+            raise EndSession(pack.text(
+                'bust', card=card, points=countable(value, 'очко', 'очка', 'очков')))
+        return pack.text('picked', card=card, hand=self.hand_texts(), value=str(value))
+
+    @StateMachine.input({'шансы'})
+    def chances(self):
+        value = self.hand_value()
+        counts = self.value_counts()
+        stand, hit = (round(100 * p) for p in self.win_chances(value, counts))
+        return packs.get(self.PACK).text('chances', stand=str(stand), hit=str(hit))
+
+    @StateMachine.input({'достаточно'})
+    @StateMachine.input({'хватит'})
+    def enough(self):
+        dealer_hand = bytearray()
+        while self.hand_value(dealer_hand) <= 17:
+            dealer_hand.append(self.deck.pop())
+
+        dealer_value = self.hand_value(dealer_hand)
+        won = dealer_value > 21 or dealer_value < self.hand_value()
+        raise EndSession(packs.get(self.PACK).text(
+            'won' if won else 'lost',
+            hand=self.hand_texts(dealer_hand), value=str(dealer_value)))
+
+
+packs.require(Game21.PACK, Game21.TEXTS)
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import asyncio
+import hashlib
+import logging
+from array import array
+from string import Template
+from collections import Counter
+
+from statemachine import Response, to_tts
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+# A content pack is a JSON file with named texts and named groups of items:
+#
+#     {"texts": {"start": "... $food ..."}, "items": {"edible": ["{🍇}{виноград}"]}}
+#
+# Texts are string.Template templates, so the {text}{tts} markup keeps its
+# braces, turned into %-formats when loaded. A pack is compiled into a flat
+# binary file next to it: the group of every item, then the offsets and the
+# UTF-8 bytes of every string, with the TTS form of each text and item
+# worked out in advance. The compiled file is memory-mapped read-only, so
+# all workers share one copy of it.
+#
+# The code using a pack declares what it needs from it with
+# `packs.require`, and a pack lacking any of that is never loaded.
+
+MAGIC = b'CPK1'
+# magic, SHA-1 of the source, number of groups, texts and items
+HEADER = struct.Struct('<4s20sIII')
+
+
+def to_format(template):
+    # a string.Template as a %-format, which is much quicker to fill in
+    def placeholder(match):
+        if match.group('escaped') is not None:
+            return '$'
+        if match.group('invalid') is not None:
+            raise ValueError(f'invalid placeholder in {template!r}')
+        return f"%({match.group('named') or match.group('braced')})s"
+    return Template.pattern.sub(placeholder, template.replace('%', '%%'))
+
+
+def compile_pack(source):
+    data = json.loads(source)
+    texts = data.get('texts', {})
+    groups = list(data.get('items', {}))
+    kinds = bytearray()
+    items = []
+    for kind, group in enumerate(groups):
+        for item in data['items'][group]:
+            kinds.append(kind)
+            items.append(item)
+    if len(groups) > 256:
+        raise ValueError('a pack can have at most 256 groups')
+
+    strings = [
+        *groups,
+        *texts, *texts.values(), *map(to_tts, texts.values()),
+        *items, *map(to_tts, items),
+    ]
+    blobs = [s.encode() for s in strings]
+    offsets = array('I', [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    # keep the offsets aligned
+    kinds += bytes(-len(kinds) % offsets.itemsize)
+    return b''.join([
+        HEADER.pack(MAGIC, hashlib.sha1(source).digest(),
+                    len(groups), len(texts), len(items)),
+        kinds, offsets.tobytes(), *blobs,
+    ])
+
+
+class Pack:
+    # A compiled pack over its mapped file. Texts are decoded up front,
+    # items the first time they're asked for; both come out interned, so
+    # sessions that hold the same item share the string.
+    __slots__ = ('stamp', 'buffer', 'kinds', 'offsets', 'strings', 'groups',
+                 'texts', 'first_item', 'items')
+
+    def __init__(self, buffer):
+        magic, self.stamp, n_groups, n_texts, n_items = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('not a compiled content pack')
+        self.buffer = memoryview(buffer)
+        start = HEADER.size
+        self.kinds = self.buffer[start:start + n_items]
+        start += n_items + -n_items % 4
+        n_strings = n_groups + 3 * n_texts + 2 * n_items
+        self.offsets = self.buffer[start:start + 4 * (n_strings + 1)].cast('I')
+        self.strings = start + 4 * (n_strings + 1)
+
+        self.groups = tuple(self.string(k) for k in range(n_groups))
+        self.texts = {
+            self.string(n_groups + k): (
+                to_format(self.string(n_groups + n_texts + k)),
+                to_format(self.string(n_groups + 2 * n_texts + k)),
+            )
+            for k in range(n_texts)
+        }
+        self.first_item = n_groups + 3 * n_texts
+        self.items = [None] * n_items
+
+    def string(self, k):
+        data = self.buffer[self.strings + self.offsets[k]:self.strings + self.offsets[k + 1]]
+        return sys.intern(str(data, 'utf-8'))
+
+    def __len__(self):
+        return len(self.items)
+
+    def item(self, k):
+        # (group, text, tts)
+        item = self.items[k]
+        if item is None:
+            item = self.items[k] = (
+                self.groups[self.kinds[k]],
+                self.string(self.first_item + k),
+                self.string(self.first_item + len(self.items) + k),
+            )
+        return item
+
+    def check(self, texts, groups, items):
+        # `texts` maps the names of the texts needed to the values they're
+        # filled in with
+        for name, keys in texts.items():
+            if name not in self.texts:
+                raise ValueError(f'no text {name!r}')
+            for template in self.texts[name]:
+                try:
+                    template % dict.fromkeys(keys, '')
+                except KeyError as e:
+                    raise ValueError(f'unknown value {e} in text {name!r}') from None
+        for group in groups:
+            if group not in self.groups:
+                raise ValueError(f'no group {group!r}')
+        if len(self) < items:
+            raise ValueError(f'{len(self)} items, at least {items} needed')
+
+    def text(self, name, **values):
+        # `values` are (text, tts) pairs or plain strings
+        text, tts = self.texts[name]
+        text_values = {}
+        tts_values = {}
+        for key, value in values.items():
+            if isinstance(value, tuple):
+                text_values[key], tts_values[key] = value
+            else:
+                text_values[key] = tts_values[key] = value
+        return Response(text % text_values, tts=tts % tts_values)
+
+
+def load_pack(path, texts=None, groups=(), items=0):
+    # the compiled file is reused while it matches the source, and replaced
+    # atomically otherwise, so workers compiling at once don't see each
+    # other's half-written files; the pack is checked against `texts`,
+    # `groups` and `items` as in Pack.check either way
+    with open(path, 'rb') as f:
+        source = f.read()
+    stamp = hashlib.sha1(source).digest()
+    compiled = path + '.bin'
+    try:
+        with open(compiled, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if HEADER.unpack_from(buffer)[:2] == (MAGIC, stamp):
+            pack = Pack(buffer)
+        else:
+            pack = None
+    except (OSError, ValueError, struct.error):
+        pack = None
+
+    if pack is None:
+        tmp = f'{compiled}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(compile_pack(source))
+        os.replace(tmp, compiled)
+        with open(compiled, 'rb') as f:
+            pack = Pack(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    pack.check(texts or {}, groups, items)
+    return pack
+
+
+class Content:
+    # The current pack of every name, <directory>/<name>.json, loaded the
+    # first time it's asked for. A pack is only ever replaced whole, so a
+    # request holding the old one keeps using it until it's done.
+    def __init__(self, directory):
+        self.directory = directory
+        self.packs = {}
+        # name -> mtime of the source the current pack was loaded from
+        self.mtimes = {}
+        # name -> keyword arguments of load_pack saying what it must contain
+        self.requirements = {}
+        self.counters = Counter()
+
+    def path(self, name):
+        return os.path.join(self.directory, f'{name}.json')
+
+    def require(self, name, texts=None, groups=(), items=0):
+        self.requirements[name] = {'texts': texts, 'groups': groups, 'items': items}
+
+    def load(self, name):
+        return load_pack(self.path(name), **self.requirements.get(name, {}))
+
+    def get(self, name):
+        pack = self.packs.get(name)
+        if pack is None:
+            self.mtimes[name] = os.stat(self.path(name)).st_mtime_ns
+            pack = self.packs[name] = self.load(name)
+        return pack
+
+    async def reload(self, name):
+        # compiling happens in a thread, requests keep the old pack meanwhile,
+        # and for good if the new one is broken or lacks what's required
+        try:
+            # a broken source isn't retried until it changes again
+            self.mtimes[name] = os.stat(self.path(name)).st_mtime_ns
+            pack = await asyncio.to_thread(self.load, name)
+        except (OSError, ValueError, KeyError, TypeError, struct.error):
+            self.counters['failed'] += 1
+            logger.exception(f'reloading content pack {name}')
+            return False
+        self.packs[name] = pack
+        self.counters['reloaded'] += 1
+        logger.info(f'content pack {name} reloaded, {len(pack)} items')
+        return True
+
+    async def watch(self, interval=2.0):
+        while True:
+            await asyncio.sleep(interval)
+            for name, mtime in list(self.mtimes.items()):
+                try:
+                    changed = os.stat(self.path(name)).st_mtime_ns != mtime
+                except OSError:
+                    continue
+                if changed:
+                    await self.reload(name)
+
+    def stats(self):
+        return {
+            'packs': {
+                name: {
+                    'sha1': pack.stamp.hex(),
+                    'items': len(pack),
+                    'texts': len(pack.texts),
+                    'bytes': len(pack.buffer),
+                }
+                for name, pack in self.packs.items()
+            },
+            **self.counters,
+        }
+
+
+# set CONTENT_DIR to load the packs from somewhere else
+packs = Content(os.environ.get(
+    'CONTENT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'content')))
@@ -0,0 +1,100 @@
+from array import array
+
+from content import packs
+from statemachine import StateMachine, EndSession, GAME_OVER, countable
+
+
+class FoodOrNot(StateMachine):
+    # the questions and texts are in content/foodornot.json
+    PACK = 'foodornot'
+    # the texts it needs, with the values they're filled in with
+    TEXTS = {
+        'start': ('food',),
+        'eaten': ('food',),
+        'thrown': ('food',),
+        'next': ('food',),
+        'poisoned': ('food', 'answers'),
+        'wasted': ('food', 'answers'),
+    }
+    GROUPS = ('edible', 'inedible')
+
+    __slots__ = ('order', 'position', 'n_correct', 'current_test')
+
+    def __init__(self, rng=None):
+        super().__init__(rng)
+        # a shuffled order of questions, reshuffled once it runs out,
+        # so that nothing is asked twice in a row of len(pack) questions
+        self.order = bytearray()
+        self.position = 0
+
+    def next_test(self):
+        pack = packs.get(self.PACK)
+        if len(self.order) != len(pack):
+            # new session, or the pack was reloaded with a different size
+            n = len(pack)
+            self.order = bytearray(range(n)) if n <= 256 else array('H', range(n))
+            self.position = len(self.order)
+        if self.position == len(self.order):
+            self.rng.shuffle(self.order)
+            self.position = 0
+        # (group, text, tts)
+        test = pack.item(self.order[self.position])
+        self.position += 1
+        return test
+
+    def start(self):
+        self.state = 'playing'
+        self.n_correct = 0
+        self.current_test = self.next_test()
+        return packs.get(self.PACK).text('start', food=self.current_test[1:])
+
+    def score(self):
+        return self.n_correct
+
+    @StateMachine.input({'съем'})
+    @StateMachine.input({'ем'})
+    @StateMachine.input({'да'})
+    @StateMachine.need_state('playing')
+    def eat(self):
+        return self.answer('edible', 'eaten', 'poisoned', 'dead')
+
+    @StateMachine.input({'ожить'})
+    @StateMachine.input({'жить'})
+    @StateMachine.input({'жить'})
+    @StateMachine.need_state('dead')
+    def resurrect(self):
+        return self.start()
+
+    @StateMachine.input({'выброшу'})
+    @StateMachine.input({'нет'})
+    @StateMachine.need_state('playing')
+    def throw(self):
+        return self.answer('inedible', 'thrown', 'wasted', 'wrong')
+
+    def answer(self, group, right, wrong, state):
+        pack = packs.get(self.PACK)
+        if self.current_test[0] == group:
+            self.n_correct += 1
+            resp = pack.text(right, food=self.current_test[1:])
+            self.current_test = self.next_test()
+            follow = pack.text('next', food=self.current_test[1:])
+            resp.text += follow.text
+            resp.tts += follow.tts
+            return resp
+        self.state = state
+        return pack.text(
+            wrong, food=self.current_test[1:],
+            answers=countable(self.n_correct, 'вопрос', 'вопроса', 'вопросов'))
+
+    @StateMachine.input({'извините'})
+    @StateMachine.need_state('wrong')
+    def apologise(self):
+        return self.start()
+
+    @StateMachine.input({'достаточно'})
+    @StateMachine.input({'выйти'})
+    def enough(self):
+        raise EndSession(GAME_OVER)
+
+
+packs.require(FoodOrNot.PACK, FoodOrNot.TEXTS, FoodOrNot.GROUPS, items=1)
@@ -0,0 +1,84 @@
+import functools
+
+
+def tolerance(word):
+    # how many typos a word of this length may have and still be recognised;
+    # both the token and the word it's taken for must allow for them
+    if len(word) <= 2:
+        return 0
+    if len(word) <= 5:
+        return 1
+    return 2
+
+
+class Trie:
+    # The known words, letter by letter. A search walks down the trie
+    # carrying one row of the edit distance table per letter, so words
+    # sharing a prefix share its rows, and a branch is abandoned as soon as
+    # every entry of its row is over the limit. Only the band of the table
+    # within `limit` of the diagonal is computed, the rest can't be in reach.
+    __slots__ = ('words', 'root', 'correct')
+
+    def __init__(self, words=()):
+        self.words = frozenset(words)
+        # a node maps letters to child nodes and None to the word ending there
+        self.root = {}
+        for word in self.words:
+            node = self.root
+            for letter in word:
+                node = node.setdefault(letter, {})
+            node[None] = word
+        self.correct = functools.lru_cache(maxsize=4096)(self._correct)
+
+    def search(self, query, limit):
+        # (distance, word) of every word within `limit` of `query`
+        ret = []
+        n = len(query)
+        out = limit + 1
+        first = [j if j <= limit else out for j in range(n + 1)]
+        stack = [(self.root, 0, first)]
+        while stack:
+            node, i, previous = stack.pop()
+            i += 1
+            lo = max(1, i - limit)
+            hi = min(n, i + limit)
+            for letter, child in node.items():
+                if letter is None:
+                    if previous[n] <= limit:
+                        ret.append((previous[n], child))
+                    continue
+                current = [out] * (n + 1)
+                if i <= limit:
+                    current[0] = best = i
+                else:
+                    best = out
+                for j in range(lo, hi + 1):
+                    # min() would be clearer, but this loop is the hot spot
+                    d = previous[j - 1] + (query[j - 1] != letter)
+                    if previous[j] < d:
+                        d = previous[j] + 1
+                    if current[j - 1] < d:
+                        d = current[j - 1] + 1
+                    current[j] = d
+                    if d < best:
+                        best = d
+                if best <= limit:
+                    stack.append((child, i, current))
+        return ret
+
+    def _correct(self, token):
+        # the known word `token` was most likely meant to be, or `token`
+        # itself if it is known already, too far off or ambiguous
+        token = token.casefold()
+        if token in self.words:
+            return token
+        limit = tolerance(token)
+        if not limit:
+            return token
+        # short words are never guessed at, or "дай" would be taken for "да"
+        found = sorted(
+            (d, word) for d, word in self.search(token, limit)
+            if d <= tolerance(word))
+        if not found or (len(found) > 1 and found[1][0] == found[0][0]):
+            return token
+        return found[0][1]
@@ -0,0 +1,119 @@
+ROW_CACHE_SIZE = 2**16
+
+# rendered rows, shared by every grid: most boards are mostly empty rows
+_rows = {}
+
+
+def render_row(palette, row, border=None):
+    # the palette is kept in the value, so its id can't be reused for
+    # a different palette while the entry exists
+    key = (id(palette), bytes(row), border)
+    try:
+        return _rows[key][1]
+    except KeyError:
+        pass
+    if len(_rows) >= ROW_CACHE_SIZE:
+        _rows.clear()
+    line = ''.join(palette[n] for n in row)
+    if border is not None:
+        line = palette[border] + line + palette[border]
+    _rows[key] = (palette, line)
+    return line
+
+
+class Grid:
+    # A board of small ints stored row after row in a bytearray. Every
+    # change marks the rows it touched as dirty, and render() only redraws
+    # those.
+    __slots__ = ('rows', 'cols', 'cells', 'dirty', 'lines', 'palette')
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.cells = bytearray(rows * cols)
+        self.lines = None
+        self.palette = None
+        self.touch()
+
+    def __getstate__(self):
+        return self.rows, self.cols, bytes(self.cells)
+
+    def __setstate__(self, state):
+        self.rows, self.cols, cells = state
+        self.cells = bytearray(cells)
+        self.lines = None
+        self.palette = None
+        self.touch()
+
+    def touch(self, rows=None):
+        if rows is None:
+            self.dirty = (1 << self.rows) - 1
+        else:
+            self.dirty |= rows
+
+    def __getitem__(self, k):
+        return self.cells[k]
+
+    def __setitem__(self, k, value):
+        self.cells[k] = value
+        self.dirty |= 1 << (k // self.cols)
+
+    def at(self, i, j):
+        return self.cells[i * self.cols + j]
+
+    def put(self, i, j, value):
+        self.cells[i * self.cols + j] = value
+        self.dirty |= 1 << i
+
+    def row(self, i):
+        return memoryview(self.cells)[i*self.cols:(i+1)*self.cols]
+
+    def set_row(self, i, values):
+        self.cells[i*self.cols:(i+1)*self.cols] = values
+        self.dirty |= 1 << i
+
+    def column(self, j):
+        return memoryview(self.cells)[j::self.cols]
+
+    def load(self, cells):
+        self.cells[:] = cells
+        self.touch()
+
+    def transpose(self):
+        assert self.rows == self.cols
+        self.cells[:] = b''.join(self.cells[j::self.cols] for j in range(self.cols))
+        self.touch()
+
+    def reverse(self):
+        # mirror every row
+        for i in range(self.rows):
+            self.cells[i*self.cols:(i+1)*self.cols] = self.row(i)[::-1]
+        self.touch()
+
+    def shift_down(self, i):
+        # drop row `i`, move the rows above it one down and clear the top one
+        self.cells[self.cols:(i+1)*self.cols] = self.cells[:i*self.cols]
+        self.cells[:self.cols] = bytes(self.cols)
+        self.touch((2 << i) - 1)
+
+    def table(self):
+        return [list(self.row(i)) for i in range(self.rows)]
+
+    def print(self):
+        for row in self.table():
+            print(''.join(str(n) for n in row))
+
+    def render(self, palette, border=None):
+        if self.palette is not palette:
+            self.palette = palette
+            self.lines = [None] * self.rows
+            self.touch()
+        i = 0
+        dirty = self.dirty
+        while dirty:
+            if dirty & 1:
+                self.lines[i] = render_row(palette, self.row(i), border)
+            dirty >>= 1
+            i += 1
+        self.dirty = 0
+        return self.lines
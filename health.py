@@ -0,0 +1,38 @@
+import asyncio
+
+
+class LoopMonitor:
+    # Sleeps for `interval` seconds at a time and measures how much later
+    # than asked it wakes up, which is how long the event loop was busy.
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        # loop time the current sleep should end at, None when not running
+        self.wake_at = None
+        self.loop = None
+
+    async def run(self):
+        self.loop = loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self.wake_at = started + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    def current_lag(self):
+        # While the loop is busy the sleep above can't end, so how overdue it
+        # is tells how far behind the loop is right now, without waiting for
+        # the wake-up to measure it.
+        if self.wake_at is None:
+            return 0.0
+        return max(0.0, self.loop.time() - self.wake_at)
+
+    def stats(self):
+        ret = {
+            'loop_lag_ms': round(1000 * self.lag, 3),
+            'max_loop_lag_ms': round(1000 * self.max_lag, 3),
+        }
+        self.max_lag = self.lag
+        return ret
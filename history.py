@@ -0,0 +1,26 @@
+class History:
+    # The latest `size` snapshots in a ring, the oldest one is overwritten
+    # when it is full. Pushing and popping are O(1) and the memory a session
+    # spends on it is bounded by `size` snapshots.
+    __slots__ = ('items', 'top', 'count')
+
+    def __init__(self, size):
+        self.items = [None] * size
+        self.top = 0
+        self.count = 0
+
+    def push(self, item):
+        self.items[self.top] = item
+        self.top = (self.top + 1) % len(self.items)
+        self.count = min(self.count + 1, len(self.items))
+
+    def pop(self):
+        if not self.count:
+            return None
+        self.top = (self.top - 1) % len(self.items)
+        item, self.items[self.top] = self.items[self.top], None
+        self.count -= 1
+        return item
+
+    def __len__(self):
+        return self.count
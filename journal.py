@@ -0,0 +1,242 @@
+import os
+import glob
+import json
+import time
+import base64
+import pickle
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class Journal:
+    # Append-only log of the handlers every session ran, together with the
+    # raw random draws each of them made. A full snapshot of a session is
+    # written every `snapshot_every` commands, so recovery only has to replay
+    # what came after the latest one. Entries are buffered in memory and
+    # written and fsynced in batches every `fsync_interval` seconds.
+    #
+    # Once a segment reaches `segment_size` bytes the next one is started,
+    # and every live session is snapshotted into it, `batch` at a time, with
+    # `dump(session_id)` giving the pickled session. The older segments are
+    # removed as soon as those snapshots are on disk. Sessions idle for more
+    # than `max_idle` seconds are forgotten: they aren't carried over, and
+    # recovery skips them.
+    def __init__(self, directory, snapshot_every=50, fsync_interval=1.0,
+                 segment_size=64 * 2**20, max_idle=7 * 86400, dump=None,
+                 batch=1000):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.max_idle = max_idle
+        self.dump = dump
+        self.batch = batch
+
+        self.buffer = []
+        # held while the file is fsynced, rotated or closed, since fsyncs
+        # run in a thread that a cancelled `run` doesn't stop
+        self.lock = threading.Lock()
+        # session -> [commands since the latest snapshot, time of the latest
+        # entry], least recently active first
+        self.counts = OrderedDict()
+        # sessions still to be snapshotted into the current segment before
+        # the older ones can go, None unless a carry-over is under way
+        self.carry = None
+        # size of the current segment when it took over
+        self.base = 0
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.segment = self.segment_number(segments[-1]) + 1 if segments else 0
+        self.file = open(self.segment_path(self.segment), 'ab')
+
+    def segment_path(self, n):
+        return os.path.join(self.directory, f'segment-{n:06}.log')
+
+    def segment_number(self, path):
+        return int(os.path.basename(path)[len('segment-'):-len('.log')])
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'segment-*.log')))
+
+    def append(self, entry):
+        self.buffer.append(json.dumps(entry).encode() + b'\n')
+
+    def begin(self, session_id, seed):
+        now = int(time.time())
+        self.append({'s': session_id, 'seed': seed, 't': now})
+        self.counts.pop(session_id, None)
+        self.counts[session_id] = [0, now]
+
+    def record(self, session_id, handler, draws, machine):
+        now = int(time.time())
+        self.append({'s': session_id, 'h': handler, 'r': draws, 't': now})
+        n, _ = self.counts.pop(session_id, (0, now))
+        n += 1
+        if n >= self.snapshot_every:
+            self.snapshot(session_id, pickle.dumps(machine), now)
+            n = 0
+        self.counts[session_id] = [n, now]
+
+    def snapshot(self, session_id, data, t):
+        # `data` is the pickled session; `t` is when it was last active, not
+        # when this is written
+        self.append({
+            's': session_id,
+            'snapshot': base64.b64encode(data).decode(),
+            't': t,
+        })
+
+    def prune(self):
+        cutoff = time.time() - self.max_idle
+        while self.counts and next(iter(self.counts.values()))[1] < cutoff:
+            self.counts.popitem(last=False)
+
+    def write(self):
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.buffer.clear()
+            self.file.flush()
+        if self.carry is None and self.file.tell() - self.base >= self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), 'ab')
+        self.base = 0
+        if self.dump is not None:
+            self.carry = list(self.counts)
+
+    def carry_over(self):
+        # snapshots the next `batch` sessions to carry over, returns whether
+        # any are left
+        for session_id in self.carry[-self.batch:]:
+            entry = self.counts.get(session_id)
+            # sessions pruned meanwhile are left behind
+            data = entry and self.dump(session_id)
+            if data is not None:
+                self.snapshot(session_id, data, entry[1])
+                entry[0] = 0
+        del self.carry[-self.batch:]
+        return bool(self.carry)
+
+    def remove_old_segments(self):
+        for path in self.segments():
+            if self.segment_number(path) < self.segment:
+                os.remove(path)
+        self.base = self.file.tell()
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def flush(self):
+        self.write()
+        self.sync()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            started = time.perf_counter()
+            self.write()
+            self.prune()
+            await asyncio.to_thread(self.sync)
+            logger.debug(
+                f'journal synced in {1000 * (time.perf_counter() - started):.2f} ms')
+            if self.carry is not None:
+                await self.finish_rotation()
+
+    async def finish_rotation(self):
+        # commands coming in meanwhile are logged before the snapshot of
+        # their session, and recovery ignores those until it sees a snapshot
+        # or seed, so requests can carry on between batches
+        started = time.perf_counter()
+        sessions = len(self.carry)
+        while self.carry_over():
+            await asyncio.sleep(0)
+        self.write()
+        await asyncio.to_thread(self.sync)
+        self.remove_old_segments()
+        self.carry = None
+        logger.info(
+            f'journal segment {self.segment} took over {sessions} sessions'
+            f' in {1000 * (time.perf_counter() - started):.2f} ms')
+
+    def close(self):
+        self.write()
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def read(self):
+        # latest snapshot (or seed) of every session, the commands after it
+        # and the time of its latest entry
+        sessions = {}
+        now = int(time.time())
+        for path in self.segments():
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning(f'torn journal entry in {path}')
+                        break
+                    session_id = entry['s']
+                    # entries from before times were logged count as recent
+                    t = entry.get('t', now)
+                    if 'seed' in entry:
+                        sessions[session_id] = [entry['seed'], None, [], t]
+                    elif 'snapshot' in entry:
+                        sessions[session_id] = [
+                            None, base64.b64decode(entry['snapshot']), [], t]
+                    elif session_id in sessions:
+                        sessions[session_id][2].append((entry['h'], entry['r']))
+                        sessions[session_id][3] = t
+        return sessions
+
+    def recover(self, factory):
+        # Rebuild every session active in the last `max_idle` seconds, with
+        # `factory(session_id, seed)` making the fresh ones, as
+        # {session_id: (machine, time it was last active)}, least recently
+        # active first. Afterwards those sessions are snapshotted into the
+        # current segment, so the older segments, along with the sessions
+        # left out, are no longer needed and get removed.
+        cutoff = time.time() - self.max_idle
+        sessions = sorted(
+            (t, session_id, seed, snapshot, commands)
+            for session_id, (seed, snapshot, commands, t) in self.read().items()
+            if t >= cutoff)
+        machines = {}
+        for t, session_id, seed, snapshot, commands in sessions:
+            if snapshot is not None:
+                machine = pickle.loads(snapshot)
+            else:
+                machine = factory(session_id, seed)
+            for handler, draws in commands:
+                machine.rng.tape = []
+                try:
+                    machine.run(handler)
+                except Exception:
+                    logger.exception(f'replaying {handler} for {session_id}')
+                if machine.rng.tape != draws:
+                    logger.warning(
+                        f'session {session_id} diverged from the journal'
+                        f' at {handler}')
+                machine.rng.tape = None
+            machines[session_id] = machine, t
+
+        for session_id, (machine, t) in machines.items():
+            self.snapshot(session_id, pickle.dumps(machine), t)
+            self.counts[session_id] = [0, t]
+        self.flush()
+        self.remove_old_segments()
+
+        return machines
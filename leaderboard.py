@@ -0,0 +1,188 @@
+import queue
+import sqlite3
+import logging
+import threading
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class Fenwick:
+    # Number of players by score, with the number of players at or below a
+    # score in O(log n). Grows to fit the highest score seen.
+    __slots__ = ('tree', 'total')
+
+    def __init__(self, size=64):
+        self.tree = [0] * (size + 1)
+        self.total = 0
+
+    def add(self, score, n=1):
+        if score + 1 >= len(self.tree):
+            self.grow(score + 1)
+        i = score + 1
+        while i < len(self.tree):
+            self.tree[i] += n
+            i += i & -i
+        self.total += n
+
+    def at_most(self, score):
+        i = min(score + 1, len(self.tree) - 1)
+        ret = 0
+        while i > 0:
+            ret += self.tree[i]
+            i -= i & -i
+        return ret
+
+    def grow(self, size):
+        new_size = len(self.tree) - 1
+        while new_size < size:
+            new_size *= 2
+        counts = [0] * (new_size + 1)
+        for score in range(len(self.tree) - 1):
+            counts[score + 1] = self.at_most(score) - self.at_most(score - 1)
+        # build the tree in place, every node passes its sum to its parent
+        for i in range(1, new_size + 1):
+            parent = i + (i & -i)
+            if parent <= new_size:
+                counts[parent] += counts[i]
+        self.tree = counts
+
+    def rank(self, score):
+        # 1 + the number of players with a higher score
+        return 1 + self.total - self.at_most(score)
+
+
+class Leaderboard:
+    # The best score of every player in every game, kept in SQLite. Writes
+    # go through a queue to a thread that commits them in batches every
+    # `flush_interval` seconds; until then they are served from `pending`.
+    # The counts by score and the top `top` entries of each game are kept in
+    # memory, so ranks and top lists don't touch the database.
+    def __init__(self, path, flush_interval=1.0, top=10):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.top_size = top
+
+        self.queue = queue.SimpleQueue()
+        self.closing = threading.Event()
+        self.lock = threading.Lock()
+        # (game, user_id) -> score, not yet committed
+        self.pending = {}
+
+        self.db = self.connect()
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS scores (
+                game TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (game, user_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS scores_by_score ON scores (game, score);
+        ''')
+
+        self.counts = {}
+        for game, score, n in self.db.execute(
+                'SELECT game, score, COUNT(*) FROM scores GROUP BY game, score'):
+            self.counts.setdefault(game, Fenwick()).add(score, n)
+        self.tops = {
+            game: self.db.execute(
+                'SELECT score, user_id FROM scores WHERE game = ?'
+                ' ORDER BY score DESC LIMIT ?', (game, top)).fetchall()
+            for game in self.counts
+        }
+
+        self.thread = threading.Thread(target=self.run, name='leaderboard', daemon=True)
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def start(self):
+        self.thread.start()
+
+    def best(self, game, user_id):
+        with self.lock:
+            score = self.pending.get((game, user_id))
+        if score is not None:
+            return score
+        row = self.db.execute(
+            'SELECT score FROM scores WHERE game = ? AND user_id = ?',
+            (game, user_id)).fetchone()
+        return row and row[0]
+
+    def submit(self, game, user_id, score):
+        if score <= 0:
+            return
+        old = self.best(game, user_id)
+        if old is not None and score <= old:
+            return
+
+        with self.lock:
+            self.pending[game, user_id] = score
+        self.queue.put((game, user_id, score))
+
+        counts = self.counts.setdefault(game, Fenwick())
+        if old is not None:
+            counts.add(old, -1)
+        counts.add(score)
+
+        top = [entry for entry in self.tops.get(game, []) if entry[1] != user_id]
+        top.append((score, user_id))
+        top.sort(key=lambda entry: -entry[0])
+        self.tops[game] = top[:self.top_size]
+
+    def top(self, game, n=None):
+        return self.tops.get(game, [])[:n]
+
+    def rank(self, game, user_id):
+        # (place, number of players, score), or None without a score
+        score = self.best(game, user_id)
+        if score is None:
+            return None
+        counts = self.counts[game]
+        return counts.rank(score), counts.total, score
+
+    def games(self):
+        return list(self.counts)
+
+    def run(self):
+        db = self.connect()
+        while True:
+            closing = self.closing.wait(self.flush_interval)
+            try:
+                self.write(db)
+            except sqlite3.Error:
+                logger.exception('writing the leaderboard')
+            if closing:
+                break
+        db.close()
+
+    def write(self, db):
+        batch = {}
+        while True:
+            try:
+                game, user_id, score = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch[game, user_id] = max(score, batch.get((game, user_id), score))
+        if not batch:
+            return
+
+        with db:
+            db.executemany(
+                'INSERT INTO scores (game, user_id, score) VALUES (?, ?, ?)'
+                ' ON CONFLICT (game, user_id) DO UPDATE SET score = excluded.score'
+                ' WHERE excluded.score > scores.score',
+                [(game, user_id, score) for (game, user_id), score in batch.items()])
+
+        with self.lock:
+            for key, score in batch.items():
+                if self.pending.get(key) == score:
+                    del self.pending[key]
+
+    def close(self):
+        self.closing.set()
+        self.thread.join()
+        self.db.close()
@@ -1,17 +1,33 @@
-import re
+import os
+import sys
+import json
+import time
 import random
+import asyncio
 import logging
+import importlib
+import contextlib
+from collections import Counter
 from typing import Dict, Any, List
-from collections import defaultdict
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request as HTTPRequest
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import PlainTextResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, Response as HTTPResponse
 from pydantic import BaseModel
 
-from tetris import TetrisField
-from snake import SnakeField
-from twentyfortyeight import TwentyFourtyEightField
+from rng import SessionRandom
+from journal import Journal
+from profiler import Profiler
+from admission import AdmissionControl, AdmissionMiddleware, Overloaded
+from health import LoopMonitor
+from memory import sizeof, shared_ids
+from leaderboard import Leaderboard
+from analytics import Analytics
+from content import packs
+from sessions import SessionStore
+from reference import Lockstep, shadow
+from statemachine import StateMachine, Response, StaticResponse, dumps
 
 
 logger = logging.getLogger('uvicorn.error')
@@ -46,664 +62,368 @@ class Item(BaseModel):
     version: str
 
 
-###
+# GAMES:
 
-def countable(n, one, few, many):
-    if n % 10 == 1:
-        return f'{n} {one}'
-    if n % 10 in {2, 3, 4}:
-        return f'{n} {few}'
-    return f'{n} {many}'
+class Game:
+    # A game the greeter can start. The module with the game is imported
+    # the first time someone starts it.
+    __slots__ = ('key', 'title', 'triggers', 'factory')
 
+    def __init__(self, key, title, triggers, factory):
+        self.key = key
+        self.title = title
+        self.triggers = triggers
+        self.factory = factory
 
-###
+    def module(self):
+        return self.factory.split(':')[0]
 
-class Response:
-    def __init__(self, text, tts=None, buttons=[], cards={}):
-        self.text = text
-        self.tts = to_tts(tts or text)
-        self.buttons = buttons
-        self.cards = cards
+    def loaded(self):
+        return self.module() in sys.modules
 
-    def json(self):
-        ret = {
-            'text': self.text,
-            'tts': self.tts,
-            'end_session': False
+    def load(self):
+        module, name = self.factory.split(':')
+        return getattr(importlib.import_module(module), name)
+
+    def starter(self):
+        def start(greeter):
+            skill = greeter.skill()
+            if self not in skill.games:
+                return greeter.greet()
+            palette = skill.palettes.get(self.key)
+            if palette is None:
+                game = self.load()(greeter.rng)
+            else:
+                game = self.load()(greeter.rng, palette)
+            skill.counters[f'started_{self.key}'] += 1
+            greeter.inhabit(game)
+            state = greeter.rng.getstate()
+            resp = game.start()
+            if (SHADOW_EVERY and hasattr(game, 'field')
+                    and random.randrange(SHADOW_EVERY) == 0):
+                game.field = shadow(game.field, state)
+            return resp
+
+        start.__name__ = f'start_{self.key}'
+        for trigger in reversed(self.triggers):
+            start = StateMachine.input(trigger)(start)
+        return start
+
+    def records(self):
+        def records(greeter):
+            if self not in greeter.skill().games:
+                return greeter.records()
+            return game_records(self, greeter.user_id)
+
+        records.__name__ = f'records_{self.key}'
+        for trigger in reversed(self.triggers):
+            if isinstance(trigger, set):
+                records = StateMachine.input({'рекорды'} | trigger)(records)
+        return records
+
+
+GAMES = (
+    Game('blackjack', '"^очк`о^"', [{'очко'}], 'blackjack:Game21'),
+    Game('foodornot', '"^съед`обно^"', [{'съедобно'}], 'foodornot:FoodOrNot'),
+    Game('tetris', '"тетрис"', [{'тетрис'}, {'tetris'}], 'tetris:Tetris'),
+    Game('snake', '"змейка"', [{'змейка'}], 'snake:Snake'),
+    Game('2048', '"2048"', [
+        {'2048'},
+        ['два', 'ноль', 'четыре', 'восемь'],
+        ['двадцать', 'сорок', 'восемь'],
+    ], 'twentyfortyeight:TwentyFourtyEight'),
+)
+
+# one game in SHADOW_EVERY also runs on the reference engine, 0 for none
+SHADOW_EVERY = int(os.environ.get('SHADOW_EVERY', 0))
+
+# a comma-separated list of game keys to expose, all of them by default
+if os.environ.get('ENABLED_GAMES'):
+    enabled = os.environ['ENABLED_GAMES'].split(',')
+    GAMES = tuple(game for game in GAMES if game.key in enabled)
+
+
+def listing(titles):
+    if len(titles) == 1:
+        return titles[0]
+    return f'{", ".join(titles[:-1])} или {titles[-1]}'
+
+
+# SKILLS:
+
+GREETING_TEXT = 'Привет!!!!! Мы команда SOFT SQUAD!!!!!!!!! Выберите одну из игр: {games}.'
+GREETING_TTS = (
+    'Привет!! Мы команда SOFT SQUAD!!'
+    ' <speaker audio=marusia-sounds/things-sword-1> '
+    ' <speaker audio=marusia-sounds/things-gun-1> '
+    ' Выберите одну из игр: {games}.'
+)
+
+
+class Skill:
+    # One of the skills served by this deployment: the games it offers, the
+    # tile palette of each game (by name, out of the game's PALETTES) and
+    # its greeting, where {games} stands for the list of its games. The
+    # game classes, their catalogues and dispatch indexes are the same for
+    # every skill; only this and the sessions are per skill.
+    __slots__ = ('key', 'games', 'palettes', 'greeting', 'counters', 'seconds')
+
+    def __init__(self, key, games=GAMES, palettes=None,
+                 text=GREETING_TEXT, tts=GREETING_TTS):
+        self.key = key
+        self.games = games
+        self.palettes = palettes or {}
+        titles = listing([game.title for game in games])
+        self.greeting = StaticResponse(
+            text=text.format(games=titles), tts=tts.format(games=titles))
+        self.counters = Counter()
+        # time spent handling the skill's requests
+        self.seconds = 0.0
+
+    def stats(self):
+        requests = self.counters['requests']
+        return {
+            'games': [game.key for game in self.games],
+            'avg_ms': round(1000 * self.seconds / requests, 3) if requests else None,
+            **self.counters,
         }
-        if self.buttons:
-            ret['buttons'] = [{'title': b} for b in self.buttons]
-        if self.cards:
-            ret['commands'] = self.cards
-        return ret
-
-
-def to_tts(s):
-    return re.sub('{.*?}{(.*?)}', r'\1', s)
-
-
-class EndSession(Exception):
-    def __init__(self, *args, **kwargs):
-        self.resp = Response(*args, **kwargs)
-
-
-def is_similar(cls, a, b):
-    def collate(s):
-        return cls._collate.get(s, s)
-    return collate(a.casefold()) == collate(b.casefold())
-
-
-class StateMachine:
-    _collate = {}
-    _inhabited_by = None
-
-    similar = {}
-
-    def __init_subclass__(cls, /, **kwargs):
-        super().__init_subclass__(**kwargs)
-        for best, good in cls.similar.items():
-            for alias in good:
-                cls._collate[alias] = best
-
-    def input(match_spec=None):
-        def matches(cls, request: Request):
-            #print(match_spec)
-            if match_spec is None:
-                return True
-            elif isinstance(match_spec, list):
-                return len(match_spec) == len(request.nlu.tokens) and all(
-                    is_similar(cls, a, b)
-                    for a, b in zip(match_spec, request.nlu.tokens)
-                )
-            elif isinstance(match_spec, str):
-                return is_similar(cls, match_spec, request.command)
-            elif isinstance(match_spec, set):
-                return all(
-                    any(
-                        is_similar(cls, required, present)
-                        for present in request.nlu.tokens)
-                    for required in match_spec
-                )
-
-        def decorator(func):
-            if not hasattr(func, '_matches'):
-                func._matches = []
-            func._matches.append(matches)
-            return func
-
-        return decorator
-
-    def need_state(*state):
-        def decorator(func):
-            func._need_state = state
-            return func
-
-        return decorator
-
-    def parse(self, request: Request):
-        if self._inhabited_by is not None:
-            try:
-                return self._inhabited_by.parse(request)
-            except EndSession as e:
-                self._inhabited_by = None
-                return e.resp
-        logger.info(f'dispatching request {request}')
-        for name, method in type(self).__dict__.items():
-            if hasattr(method, '_matches'):
-                logger.info(f'testing method {name}')
-                if any(matches(type(self), request)
-                       for matches in method._matches):
-                    logger.info('input matches')
-                    if ((not hasattr(method, '_need_state'))
-                            or self.state in method._need_state):
-                        logger.info('state correct. matched.')
-                    else:
-                        logger.info('state incorrect')
-                else:
-                    logger.info("input doesn't match")
-            if (
-                    hasattr(method, '_matches')
-                    and any(
-                        matches(type(self), request)
-                        for matches in method._matches)
-                    and ((not hasattr(method, '_need_state'))
-                         or self.state in method._need_state)):
-                return method(self)
-        return 'Команда не распознана'
-
-    def inhabit(self, state_machine):
-        assert self._inhabited_by is None
-        state_machine.inhabitor = self
-        self._inhabited_by = state_machine
-
-    def __init__(self):
-        self.state = None
-
-
-# BLACKJACK:
-
-class Card:
-    def __init__(self, suit, number):
-        self.suit = suit
-        self.number = number
-
-    def __repr__(self):
-        tts_number = {
-            6: 'шестёрка',
-            7: 'семёрка',
-            8: 'восьмёрка',
-            9: 'девятка',
-            10: 'десятка',
-            'J': 'валет',
-            'Q': 'дама',
-            'K': 'король',
-            'A': 'туз',
-        }[self.number]
-
-        tts_suit = {
-            '♠️': 'пик',
-            '♦️': 'бубен',
-            '♣️': 'крестей',
-            '♥️': 'червей'
-        }[self.suit]
-
-        return f'{{{self.number}{self.suit}}}{{{tts_number} {tts_suit}}}'
-
-    def value(self):
-        return self.number if isinstance(self.number, int) else {
-            'J': 2,
-            'Q': 3,
-            'K': 4,
-            'A': 11
-        }[self.number]
-
-
-class Game21(StateMachine):
-    similar = {
-        'ещё': ['еще'],
-    }
 
-    DECK = [
-        Card(suit, number)
-        for suit in ['♠️', '♦️', '♣️', '♥️']
-        for number in list(range(6, 11)) + ['J', 'Q', 'K', 'A']
-    ]
 
-    def __init__(self):
-        self.deck = self.DECK.copy()
-        random.shuffle(self.deck)
-        self.hand = []
-
-    def get_card(self):
-        card = self.deck.pop()
-        self.hand.append(card)
-        return card
-
-    def hand_value(self, hand=None):
-        if hand is None:
-            hand = self.hand
-        return sum(card.value() for card in hand)
-
-    def hand_str(self, hand=None):
-        if hand is None:
-            hand = self.hand
-        return " ".join(repr(card) for card in hand)
-
-    def start(self):
-        self.state = ''
-        return Response(
-            'Играем в двадцать одно!'
-            ' Чтобы взять карту, {напишите}{скажите} "Ещё!".'
-            ' Чтобы закончить брать карты, {напишите}{скажите} "Хватит!".'
-            '\n\n'
-            'К сожалению, у этого отладчика есть незадокументированная'
-            ' фича, которая автоматически закрывает его при команде "хватит".'
-            ' Чтобы сессия отладчика не рвалась, вы можете использовать'
-            ' команду "достаточно" вместо команды "хватит". Возможно,'
-            ' авторам заданий следовало бы при их составлении учесть то, как'
-            ' работает ^отладчик^, не ^считаете^?'
-            '\n\n'
-            f'В любом случае, ваша первая карта: {self.get_card()}.\n'
-            f'Количество очков: {self.hand_value()}\n\n'
-            'Ещё или хватит?'
-        )
+def load_skills(path):
+    # {skill_id: {"games": [keys], "palettes": {key: palette}, "text": ..., "tts": ...}}
+    # with every field optional
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    by_key = {game.key: game for game in GAMES}
+    skills = {}
+    for skill_id, options in config.items():
+        keys = options.get('games', list(by_key))
+        unknown = [key for key in keys if key not in by_key]
+        if unknown:
+            raise ValueError(f'skill {skill_id} has unknown games {unknown}')
+        palettes = options.get('palettes', {})
+        for key, palette in palettes.items():
+            if key not in keys:
+                raise ValueError(f'skill {skill_id} sets a palette for {key}, which it lacks')
+            if palette not in getattr(by_key[key].load(), 'PALETTES', {}):
+                raise ValueError(f'skill {skill_id} sets unknown palette {palette!r} for {key}')
+        skills[skill_id] = Skill(
+            skill_id, tuple(by_key[key] for key in keys), palettes,
+            options.get('text', GREETING_TEXT), options.get('tts', GREETING_TTS))
+    return skills
+
+
+# requests from skills that aren't configured get every game
+DEFAULT_SKILL = Skill('default')
+
+# set SKILLS_PATH to a JSON file to serve several skills, see load_skills
+SKILLS = load_skills(os.environ['SKILLS_PATH']) if os.environ.get('SKILLS_PATH') else {}
+
+
+def get_skill(key):
+    return SKILLS.get(key, DEFAULT_SKILL)
+
+
+# LEADERBOARD:
+
+# game class name -> key the game's scores are kept under
+GAME_KEYS = {game.factory.split(':')[1]: game.key for game in GAMES}
+
+NO_RECORDS = StaticResponse('Рекордов пока нет.')
+
+
+def game_records(game, user_id):
+    top = leaderboard.top(game.key) if leaderboard is not None else []
+    if not top:
+        return NO_RECORDS
+    return f'Рекорды в игре {game.title}:\n' + '\n'.join(
+        f'{place}. {score}' + (' (вы)' if player == user_id else '')
+        for place, (score, player) in enumerate(top, 1)
+    )
+
+
+def all_records(games):
+    lines = []
+    if leaderboard is not None:
+        for game in games:
+            top = leaderboard.top(game.key, 3)
+            if top:
+                lines.append(f'{game.title}: {", ".join(str(score) for score, _ in top)}')
+    if not lines:
+        return NO_RECORDS
+    return Response(
+        'Лучшие результаты:\n' + '\n'.join(lines)
+        + '\n\nЧтобы увидеть все рекорды игры, {напишите}{скажите} "рекорды"'
+        ' и её название.'
+    )
+
+
+def places(games, user_id):
+    lines = []
+    if leaderboard is not None:
+        for game in games:
+            rank = leaderboard.rank(game.key, user_id)
+            if rank is not None:
+                place, total, score = rank
+                lines.append(
+                    f'{game.title}: {place} место из {total}, ваш рекорд {score}')
+    if not lines:
+        return 'У вас пока нет рекордов.'
+    return '\n'.join(lines)
+
+
+def record_score(game, user_id):
+    score = game.score()
+    if score is not None:
+        leaderboard.submit(GAME_KEYS[type(game).__name__], user_id, score)
 
-    @StateMachine.input({'ещё'})
-    def pick(self):
-        assert self.hand_value() < 21
-        card = self.get_card()
-        message = f'Вы вытянули карту {card}.\n\n'
-        if self.hand_value() == 21:
-            message += 'Вы набрали ровно {21}{двадцать одно} очко и выиграли!'
-            raise EndSession(message)
-        elif self.hand_value() > 21:
-            if self.hand_value() < 25:
-                message += f'Перебор! У вас оказалось {self.hand_value()} очка.'
-            else:
-                message += f'Перебор! У вас оказалось {self.hand_value()} очков.'
-            raise EndSession(message)
-        else:
-            message += f'Ваша рука: {self.hand_str()}\n'
-            message += f'Количество очков: {self.hand_value()}\n\n'
-            message += 'Ещё или хватит?'
-            return message
-
-    @StateMachine.input({'достаточно'})
-    @StateMachine.input({'хватит'})
-    def enough(self):
-        dealer_hand = []
-        while self.hand_value(dealer_hand) <= 17:
-            dealer_hand.append(self.deck.pop())
-
-        dealer_value = self.hand_value(dealer_hand)
-        if dealer_value > 21 or dealer_value < self.hand_value():
-            message = 'Вы выиграли!\n\n'
-        else:
-            message = 'Вы проиграли.\n\n'
-        message += f'Рука банкира: {self.hand_str(dealer_hand)}\n'
-        message += f'Количество очков банкира: {dealer_value}'
-        raise EndSession(message)
-
-
-# FOOD OR NOT:
-
-class FoodOrNot(StateMachine):
-    FOOD = [
-        (True, '{🍇}{виноград}'),
-        (True, '{🍉}{арбуз}'),
-        (True, '{🍊}{мандарин}'),
-        (True, '{🍌}{банан}'),
-        (True, '{🍍}{ананас}'),
-        (True, '{🥭}{манго}'),
-        (True, '{🍎}{яблоко}'),
-        (True, '{🍐}{грушу}'),
-        (True, '{🍑}{персик}'),
-        (True, '{🍒}{вишню}'),
-        (True, '{🍓}{клубнику}'),
-        (True, '{🫐}{чернику}'),
-        (True, '{🥝}{киви}'),
-        (True, '{🍅}{помидор}'),
-        (True, '{🥥}{кокос}'),
-        (True, '{🥑}{авокадо}'),
-        (True, '{🍆}{баклажан}'),
-        (True, '{🥔}{картошку}'),
-        (True, '{🌽}{кукурузу}'),
-        (True, '{🌶️}{перец}'),
-        (True, '{🥒}{огурец}'),
-        (True, '{🍞}{хлеб}'),
-        (True, '{🥐}{круассан}'),
-        (True, '{🥖}{багет}'),
-        (True, '{🧀}{сыр}'),
-        (True, '{🍕}{пиццу}'),
-        (True, '{🥪}{бутерброд}'),
-        (True, '{🍙}{онигири}'),
-        (True, '{🍚}{рис}'),
-        (True, '{🍝}{спагетти}'),
-        (True, '{🍣}{суши}'),
-        (True, '{🍨}{мороженое}'),
-        (True, '{🥧}{пирог}'),
-        (True, '{🍫}{шоколад}'),
-
-        (False, '{🕳️}{дыру}'),
-        (False, '{💣}{бомба}'),
-        (False, '{🔪}{нож}'),
-        (False, '{🧭}{компас}'),
-        (False, '{🧱}{стену}'),
-        (False, '{🛢️}{нефть}'),
-        (False, '{🧳}{чемодан}'),
-        (False, '{⏰}{будильник}'),
-        (False, '{🌡️}{градусник}'),
-        (False, '{🧨}{динамит}'),
-        (False, '{🪁}{воздушный змей}'),
-        (False, '{🖼️}{картину}'),
-        (False, '{💽}{диск}'),
-        (False, '{💾}{дискету}'),
-        (False, '{📺}{телевизор}'),
-        (False, '{📷}{фотоаппарат}'),
-        (False, '{📼}{кассету}'),
-        (False, '{🔍}{лупу}'),
-        (False, '{💡}{лампочку}'),
-        (False, '{📖}{книгу}'),
-        (False, '{📎}{скрепку}'),
-        (False, '{📏}{линейку}'),
-        (False, '{🗝️}{ключ}'),
-        (False, '{🔨}{молоток}'),
-        (False, '{🪓}{топор}'),
-        (False, '{🪚}{пила}'),
-        (False, '{🗜️}{струбцину}'),
-        (False, '{🧲}{магнит}'),
-        (False, '{🔭}{телескоп}'),
-        (False, '{🪠}{вантуз}'),
-        (False, '{🧹}{веник}'),
-        (False, '{🧽}{мочалку}'),
+
+# GREETER:
+
+def game_handlers():
+    # "рекорды <game>" has to be tried before the game's own start handler,
+    # and one start_<key> handler per game ahead of the catch-all greet; the
+    # handlers of games the session's skill lacks fall through to it
+    return [
+        *((f'records_{game.key}', game.records()) for game in GAMES),
+        *((f'start_{game.key}', game.starter()) for game in GAMES),
     ]
 
-    def start(self):
-        self.state = 'playing'
-        self.n_correct = 0
-        self.current_test = random.choice(self.FOOD)
-        return Response(
-            'Играем в съедобно-несъед`обно!'
-            ' Отвечайте на вопрос либо "съем" либо "выброшу".'
-            '\n\n'
-            f'Первый вопрос: съели ли бы вы {self.current_test[1]}?'
-        )
 
-    @StateMachine.input({'съем'})
-    @StateMachine.input({'ем'})
-    @StateMachine.input({'да'})
-    @StateMachine.need_state('playing')
-    def eat(self):
-        if self.current_test[0]:
-            self.n_correct += 1
-            message = f'Правильно! {self.current_test[1]} можно смело кушать.'
-            self.current_test = random.choice(self.FOOD)
-            message += f' Следующий вопрос: съели ли бы вы {self.current_test[1]}?'
-            return Response(message)
-        self.state = 'dead'
-        return Response(
-            f'Нет! {self.current_test[1]} ни в коем случае нельзя есть!'
-            ' Вы отравились и умерли.'
-            '\n\n'
-            'До своей смерти вы успели правильно ответить на'
-            f' {countable(self.n_correct, "вопрос", "вопроса", "вопросов")}.'
-            ' Чтобы начать снова, {напишите}{скажите} "ожить"{,}{.} чтобы выйти'
-            ' {напишите}{скажите} "достаточно".'
-        )
+class Greeter(StateMachine, handlers=game_handlers()):
+    similar = {
+        'съедобно': ['съедобное'],
+        'моё': ['мое'],
+    }
 
-    @StateMachine.input({'ожить'})
-    @StateMachine.input({'жить'})
-    @StateMachine.input({'жить'})
-    @StateMachine.need_state('dead')
-    def resurrect(self):
-        return self.start()
-
-    @StateMachine.input({'выброшу'})
-    @StateMachine.input({'нет'})
-    @StateMachine.need_state('playing')
-    def throw(self):
-        if not self.current_test[0]:
-            self.n_correct += 1
-            message = f'Правильно! {self.current_test[1]} кушать нельзя.'
-            self.current_test = random.choice(self.FOOD)
-            message += f' Следующий вопрос: съели ли бы вы {self.current_test[1]}?'
-            return Response(message)
-        self.state = 'wrong'
-        return Response(
-            f'Как же так! Вы решили выбросить {self.current_test[1]}.'
-            ' А в Африке дети от голода умирают. Вы вообще знаете{}{,} как люди'
-            ' в блокаду жили?!'
-            '\n\n'
-            'До этого варварского поступка вы успели правильно ответить на'
-            f' {countable(self.n_correct, "вопрос", "вопроса", "вопросов")}.'
-            ' Чтобы начать снова, {напишите}{скажите} "извините"{,}{.} чтобы выйти'
-            ' {напишите}{скажите} "достаточно".'
-        )
+    __slots__ = ('seed', 'user_id', 'skill_key')
 
-    @StateMachine.input({'извините'})
-    @StateMachine.need_state('wrong')
-    def apologise(self):
-        return self.start()
+    def __init__(self, seed=None, skill_key=DEFAULT_SKILL.key):
+        # the whole session draws from one generator, so the seed and the
+        # log of requests are enough to replay it
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed
+        # set on every request, for the leaderboard commands
+        self.user_id = None
+        self.skill_key = skill_key
+        super().__init__(SessionRandom(seed))
 
-    @StateMachine.input({'достаточно'})
-    @StateMachine.input({'выйти'})
-    def enough(self):
-        raise EndSession('Игра закончена.')
+    def skill(self):
+        return get_skill(self.skill_key)
 
+    @StateMachine.input({'рекорды'})
+    def records(self):
+        return all_records(self.skill().games)
 
-# TETRIS:
+    @StateMachine.input({'моё', 'место'})
+    def place(self):
+        return places(self.skill().games, self.user_id)
 
-class Tetris(StateMachine):
-    similar = {
-        'налево': ['лево', 'влево'],
-        'направо': ['право', 'вправо'],
-        'вниз': ['низ'],
-    }
+    @StateMachine.input()
+    def greet(self):
+        return self.skill().greeting
 
-    def start(self):
-        self.field = TetrisField()
-        message = (
-            'Играем в тетрис! Доступные команды: "налево", "направо", "вниз",'
-            ' "поворот" (против часовой стрелки). Если у вас неправильно'
-            ' отображаются плитки, напишите "плитки".\n\n'
-        )
-        return Response(
-            message + self.field.emoji(),
-            tts=message
-        )
 
-    @StateMachine.input({'плитки'})
-    def bw_emoji(self):
-        self.field.emoji_ = ['⬜', '⬛', '⬛', '⬛', '⬛', '⬛', '⬛', '⬛', '⬛']
-        return self.field.emoji()
-
-    @StateMachine.input({'налево'})
-    def left(self):
-        if self.field.loss():
-            raise EndSession('Вы проиграли.')
-        self.field.left()
-        self.field.step()
-        return self.field.emoji()
-
-    @StateMachine.input({'направо'})
-    def right(self):
-        if self.field.loss():
-            raise EndSession('Вы проиграли.')
-        self.field.right()
-        self.field.step()
-        return self.field.emoji()
-
-    @StateMachine.input({'вниз'})
-    def down(self):
-        if self.field.loss():
-            raise EndSession('Вы проиграли.')
-        self.field.multistep()
-        return self.field.emoji()
-
-    @StateMachine.input({'поворот'})
-    def rotate(self):
-        if self.field.loss():
-            raise EndSession('Вы проиграли.')
-        self.field.rotate()
-        self.field.step()
-        return self.field.emoji()
-
-    @StateMachine.input({'достаточно'})
-    @StateMachine.input({'выйти'})
-    def enough(self):
-        raise EndSession('Игра закончена.')
-
-
-# Snake:
-
-class Snake(StateMachine):
-    similar = {
-        'налево': ['лево', 'влево'],
-        'направо': ['право', 'вправо'],
-        'вниз': ['низ'],
-        'вверх': ['верх'],
-    }
+def replay(seed, requests, skill_key=DEFAULT_SKILL.key):
+    greeter = Greeter(seed, skill_key)
+    return [greeter.parse(request) for request in requests]
 
-    def start(self):
-        self.field = SnakeField()
-        message = (
-            'Играем в змейку! Доступные команды: "налево", "направо", "вниз",'
-            ' "вверх". Если у вас неправильно'
-            ' отображаются плитки, напишите "плитки".\n\n'
-        )
-        return Response(
-            message + self.field.emoji(),
-            tts=message
-        )
 
-    @StateMachine.input({'плитки'})
-    def bw_emoji(self):
-        self.field.emoji_ = ['⬜', '⬛', '🐍', '🔴', '💥']
-        return self.field.emoji()
-
-    @StateMachine.input({'налево'})
-    def left(self):
-        self.field.left()
-        ret = self.field.emoji()
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        return ret
-
-    @StateMachine.input({'направо'})
-    def right(self):
-        self.field.right()
-        ret = self.field.emoji()
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        return ret
-
-    @StateMachine.input({'вверх'})
-    def up(self):
-        self.field.up()
-        ret = self.field.emoji()
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        return ret
-
-    @StateMachine.input({'вниз'})
-    def down(self):
-        self.field.down()
-        ret = self.field.emoji()
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        return ret
-
-    @StateMachine.input({'достаточно'})
-    @StateMachine.input({'выйти'})
-    def enough(self):
-        raise EndSession('Игра закончена.')
-
-
-# 2048:
-
-class TwentyFourtyEight(StateMachine):
-    similar = {
-        'налево': ['лево', 'влево'],
-        'направо': ['право', 'вправо'],
-        'вниз': ['низ'],
-        'вверх': ['верх'],
-    }
+# set SESSION_COLD_PATH to move sessions idle for SESSION_IDLE_SECONDS out
+# of memory into that file
+statemachines = SessionStore()
 
-    def start(self):
-        self.field = TwentyFourtyEightField()
-        message = (
-            'Играем в {2048}{двадцать сорок восемь}! Доступные команды: "налево", "направо", "вниз",'
-            ' "вверх". Значения на иконках соответствуют показателям степени двойки.\n\n'
-        )
-        return Response(
-            message + self.field.emoji(),
-            tts=message
-        )
+# set JOURNAL_DIR to make sessions survive restarts
+journal = None
 
-    @StateMachine.input({'налево'})
-    def left(self):
-        self.field.left()
-        ret = f'{{{self.field.emoji()}}}{{}}'
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        elif self.field.win():
-            raise EndSession(f'{ret}\n\nВы выиграли!')
-        return ret
-
-    @StateMachine.input({'направо'})
-    def right(self):
-        self.field.right()
-        ret = f'{{{self.field.emoji()}}}{{}}'
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        elif self.field.win():
-            raise EndSession(f'{ret}\n\nВы выиграли!')
-        return ret
-
-    @StateMachine.input({'вверх'})
-    def up(self):
-        self.field.up()
-        ret = f'{{{self.field.emoji()}}}{{}}'
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        elif self.field.win():
-            raise EndSession(f'{ret}\n\nВы выиграли!')
-        return ret
-
-    @StateMachine.input({'вниз'})
-    def down(self):
-        self.field.down()
-        ret = f'{{{self.field.emoji()}}}{{}}'
-        if self.field.loss():
-            raise EndSession(f'{ret}\n\nВы проиграли.')
-        elif self.field.win():
-            raise EndSession(f'{ret}\n\nВы выиграли!')
-        return ret
-
-    @StateMachine.input({'достаточно'})
-    @StateMachine.input({'выйти'})
-    def enough(self):
-        raise EndSession('Игра закончена.')
+# set LEADERBOARD_PATH to keep the best scores in that SQLite database
+leaderboard = None
 
+# set ANALYTICS_DIR to log every command there as gzipped JSON lines
+analytics = None
 
-# GREETER:
+profiler = Profiler(every=int(os.environ.get('PROFILE_EVERY', 0)))
 
-class Greeter(StateMachine):
-    similar = {
-        'съедобно': 'съедобное'
-    }
+loop_monitor = LoopMonitor()
 
-    @StateMachine.input({'очко'})
-    def start_quiz(self):
-        game = Game21()
-        self.inhabit(game)
-        return game.start()
-
-    @StateMachine.input({'съедобно'})
-    def start_foodornot(self):
-        game = FoodOrNot()
-        self.inhabit(game)
-        return game.start()
-
-    @StateMachine.input({'тетрис'})
-    @StateMachine.input({'tetris'})
-    def start_tetris(self):
-        game = Tetris()
-        self.inhabit(game)
-        return game.start()
-
-    @StateMachine.input({'змейка'})
-    def start_snake(self):
-        game = Snake()
-        self.inhabit(game)
-        return game.start()
-
-    @StateMachine.input({'2048'})
-    @StateMachine.input(['два', 'ноль', 'четыре', 'восемь'])
-    @StateMachine.input(['двадцать', 'сорок', 'восемь'])
-    def start_2048(self):
-        game = TwentyFourtyEight()
-        self.inhabit(game)
-        return game.start()
+admission = AdmissionControl(
+    limit=int(os.environ.get('ADMISSION_LIMIT', 256)),
+    max_wait=float(os.environ.get('ADMISSION_MAX_WAIT', 1.0)),
+    rate=float(os.environ.get('ADMISSION_USER_RATE', 5.0)),
+    burst=int(os.environ.get('ADMISSION_USER_BURST', 10)),
+    monitor=loop_monitor,
+)
 
-    @StateMachine.input()
-    def greet(self):
-        return Response(
-            text=(
-                'Привет!!!!! Мы команда SOFT SQUAD!!!!!!!!!'
-                ' Выберите одну из игр: "^очк`о^", "^съед`обно^", "тетрис", "змейка" или "2048".'),
-            tts=(
-                'Привет!! Мы команда SOFT SQUAD!!'
-                ' <speaker audio=marusia-sounds/things-sword-1> '
-                ' <speaker audio=marusia-sounds/things-gun-1> '
-                ' Выберите одну из игр: "^очк`о^", "^съед`обно^", "тетрис", "змейка" или "2048".'),
+BUSY = StaticResponse(
+    'Сейчас слишком много игроков. Попробуйте ещё раз через пару секунд.')
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global statemachines, journal, leaderboard, analytics
+    tasks = [
+        asyncio.create_task(loop_monitor.run()),
+        # content packs are reloaded when their files change
+        asyncio.create_task(packs.watch(
+            float(os.environ.get('CONTENT_RELOAD_INTERVAL', 2.0)))),
+    ]
+    if os.environ.get('SESSION_COLD_PATH'):
+        statemachines = SessionStore(
+            os.environ['SESSION_COLD_PATH'],
+            idle_after=float(os.environ.get('SESSION_IDLE_SECONDS', 300)),
+        )
+        tasks.append(asyncio.create_task(statemachines.run()))
+    if os.environ.get('JOURNAL_DIR'):
+        journal = Journal(
+            os.environ['JOURNAL_DIR'],
+            snapshot_every=int(os.environ.get('JOURNAL_SNAPSHOT_EVERY', 50)),
+            fsync_interval=float(os.environ.get('JOURNAL_FSYNC_INTERVAL', 1.0)),
+            max_idle=float(os.environ.get('JOURNAL_MAX_IDLE', 7 * 86400)),
+            segment_size=int(os.environ.get('JOURNAL_SEGMENT_SIZE', 64 * 2**20)),
+            dump=statemachines.dump,
         )
+        # sessions long idle go straight back to the cold tier, if there's one
+        now = time.time()
+        for key, (machine, t) in journal.recover(recovered_greeter).items():
+            statemachines.restore(key, machine, now - t)
+        logger.info(f'recovered {len(statemachines)} sessions from the journal')
+        tasks.append(asyncio.create_task(journal.run()))
+    if os.environ.get('LEADERBOARD_PATH'):
+        leaderboard = Leaderboard(
+            os.environ['LEADERBOARD_PATH'],
+            flush_interval=float(os.environ.get('LEADERBOARD_FLUSH_INTERVAL', 1.0)),
+        )
+        leaderboard.start()
+    if os.environ.get('ANALYTICS_DIR'):
+        analytics = Analytics(
+            os.environ['ANALYTICS_DIR'],
+            queue_size=int(os.environ.get('ANALYTICS_QUEUE', 10000)),
+            flush_interval=float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 1.0)),
+            segment_size=int(os.environ.get('ANALYTICS_SEGMENT_SIZE', 16 * 2**20)),
+            keep=int(os.environ.get('ANALYTICS_KEEP', 0)),
+        )
+        tasks.append(asyncio.create_task(analytics.run()))
 
+    yield
 
-statemachines = defaultdict(Greeter)
+    # by now uvicorn has stopped accepting requests and let the
+    # in-flight ones finish
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if journal is not None:
+        journal.close()
+        logger.info('journal flushed')
+    if leaderboard is not None:
+        leaderboard.close()
+    if analytics is not None:
+        analytics.close()
+    statemachines.close()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(AdmissionMiddleware, admission=admission, paths={'/marusya'})
 
 
 @app.exception_handler(RequestValidationError)
@@ -712,11 +432,139 @@ async def validation_exception_handler(request, exc):
     return PlainTextResponse('', status_code=400)
 
 
-@app.post('/marusya')
-async def read_root(req: Item):
-    resp = statemachines[req.session.session_id].parse(req.request)
+def active_game(machine):
+    while machine._inhabited_by is not None:
+        machine = machine._inhabited_by
+    return type(machine).__name__
+
+
+@app.get('/stats/memory')
+async def memory_stats(sample: int = 1000):
+    # Sessions only reference the catalogues, palettes and shapes that are
+    # defined in the game modules, so those are left out of the per-session
+    # size. Sessions in the cold tier aren't in memory and aren't sampled.
+    shared = shared_ids(*(
+        sys.modules[game.module()] for game in GAMES if game.loaded()))
+    sessions = list(statemachines.values())
+    if len(sessions) > sample:
+        sessions = random.sample(sessions, sample)
 
-    if isinstance(resp, Response):
+    totals = {}
+    for machine in sessions:
+        game = active_game(machine)
+        n, size = totals.get(game, (0, 0))
+        totals[game] = n + 1, size + sizeof(machine, shared)
+
+    return {
+        'sessions': len(statemachines),
+        'resident': len(statemachines.hot),
+        'sampled': len(sessions),
+        'games': {
+            game: {'sampled': n, 'avg_bytes': size // n}
+            for game, (n, size) in totals.items()
+        },
+    }
+
+
+def local_only(request):
+    if request.client is None or request.client.host not in {'127.0.0.1', '::1'}:
+        raise HTTPException(status_code=403)
+
+
+@app.get('/debug/profile')
+async def profile_stacks(request: HTTPRequest):
+    local_only(request)
+    return PlainTextResponse(profiler.collapsed())
+
+
+@app.get('/healthz')
+async def healthz():
+    return {
+        'status': 'ok',
+        'sessions': len(statemachines),
+        **loop_monitor.stats(),
+    }
+
+
+@app.get('/stats/admission')
+async def admission_stats():
+    return admission.stats()
+
+
+@app.get('/stats/sessions')
+async def session_stats():
+    return statemachines.stats()
+
+
+@app.get('/stats/analytics')
+async def analytics_stats():
+    return analytics.stats() if analytics is not None else {}
+
+
+@app.get('/stats/content')
+async def content_stats():
+    return packs.stats()
+
+
+@app.post('/debug/content/{name}/reload')
+async def reload_content(request: HTTPRequest, name: str):
+    local_only(request)
+    if name not in packs.packs:
+        raise HTTPException(status_code=404)
+    return {'reloaded': await packs.reload(name)}
+
+
+@app.get('/stats/skills')
+async def skill_stats():
+    return {
+        skill.key: skill.stats()
+        for skill in (DEFAULT_SKILL, *SKILLS.values())
+    }
+
+
+@app.get('/stats/shadow')
+async def shadow_stats():
+    return {'every': SHADOW_EVERY, **Lockstep.counters}
+
+
+@app.post('/debug/profile')
+async def configure_profiler(request: HTTPRequest, every: int = 0,
+                             session_id: str = None, reset: bool = False):
+    # every=0 without a session_id turns profiling off
+    local_only(request)
+    profiler.every = every
+    profiler.session_id = session_id
+    if reset:
+        profiler.reset()
+    return {
+        'every': profiler.every,
+        'session_id': profiler.session_id,
+        'profiled': profiler.profiled,
+    }
+
+
+def handle(session_id, machine, request):
+    handler = machine.dispatch(request)
+    if journal is None or handler is None:
+        return handler, machine.run(handler)
+
+    machine.rng.tape = []
+    try:
+        return handler, machine.run(handler)
+    finally:
+        draws, machine.rng.tape = machine.rng.tape, None
+        journal.record(session_id, handler, draws, machine)
+
+
+def render(req, resp):
+    if isinstance(resp, StaticResponse):
+        return HTTPResponse(
+            b'{"response":' + resp.body
+            + b',"session":' + dumps(jsonable_encoder(req.session))
+            + b',"version":' + dumps(req.version) + b'}',
+            media_type='application/json',
+        )
+    elif isinstance(resp, Response):
         resp = resp.json()
     elif isinstance(resp, str):
         resp = {
@@ -736,3 +584,78 @@ async def read_root(req: Item):
         'session': req.session,
         'version': req.version,
     }
+
+
+def session_key(skill_id, session_id):
+    # sessions of different skills never mix, even with the same id
+    return f'{skill_id}:{session_id}'
+
+
+def recovered_greeter(key, seed):
+    return Greeter(seed, get_skill(key.split(':', 1)[0]).key)
+
+
+def process(req):
+    started = time.perf_counter()
+    skill = get_skill(req.session.skill_id)
+    skill.counters['requests'] += 1
+    session_id = req.session.session_id
+    key = session_key(req.session.skill_id, session_id)
+    if key not in statemachines:
+        greeter = Greeter(skill_key=skill.key)
+        logger.info(
+            f'new session {session_id} of skill {req.session.skill_id}'
+            f' with seed {greeter.seed}')
+        skill.counters['sessions'] += 1
+        statemachines[key] = greeter
+        if journal is not None:
+            journal.begin(key, greeter.seed)
+    machine = statemachines[key]
+    machine.user_id = req.session.user_id
+    game = machine._inhabited_by
+    state = game and game.state
+
+    if profiler.wanted(session_id):
+        handler, resp = profiler.call(handle, key, machine, req.request)
+    else:
+        handler, resp = handle(key, machine, req.request)
+    if handler is None:
+        skill.counters['unrecognised'] += 1
+
+    # a score counts once the game ends or moves on to a new round
+    if (leaderboard is not None and game is not None
+            and (machine._inhabited_by is not game or game.state != state)):
+        record_score(game, req.session.user_id)
+
+    resp = render(req, resp)
+    elapsed = time.perf_counter() - started
+    skill.seconds += elapsed
+    if analytics is not None:
+        current = machine._inhabited_by
+        if handler is None:
+            outcome = 'unrecognised'
+        elif game is None:
+            outcome = 'ok' if current is None else 'started'
+        else:
+            outcome = 'ok' if current is game else 'ended'
+        played = game or current
+        analytics.record({
+            'ts': round(time.time(), 3),
+            'skill': skill.key,
+            'session': session_id,
+            'game': played and GAME_KEYS.get(type(played).__name__),
+            'command': req.request.command,
+            'handler': handler,
+            'ms': round(1000 * elapsed, 3),
+            'outcome': outcome,
+        })
+    return resp
+
+
+@app.post('/marusya')
+async def read_root(req: Item, request: HTTPRequest):
+    try:
+        admission.admit(req.session.user_id, request.scope.get('state', {}))
+    except Overloaded:
+        return render(req, BUSY)
+    return process(req)
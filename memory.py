@@ -0,0 +1,67 @@
+import sys
+from collections import deque
+
+
+CONTAINERS = (list, tuple, set, frozenset, deque)
+
+
+def shared_ids(*roots):
+    # ids of everything reachable from the module-level names of the `roots`
+    # modules, including class attributes
+    ret = set()
+    stack = []
+    for root in roots:
+        stack.extend(vars(root).values())
+    while stack:
+        obj = stack.pop()
+        if id(obj) in ret:
+            continue
+        ret.add(id(obj))
+        if isinstance(obj, type):
+            stack.extend(vars(obj).values())
+        elif isinstance(obj, CONTAINERS):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+    return ret
+
+
+def is_shared(obj):
+    # Strings held by sessions are states and other literals from the code,
+    # small ints are cached by the interpreter, types and functions belong to
+    # the module.
+    return (
+        obj is None
+        or isinstance(obj, (str, bool, type))
+        or (isinstance(obj, int) and -5 <= obj <= 256)
+        or callable(obj)
+    )
+
+
+def sizeof(obj, shared=frozenset(), seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or id(obj) in shared or is_shared(obj):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, CONTAINERS):
+        size += sum(sizeof(x, shared, seen) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(
+            sizeof(k, shared, seen) + sizeof(v, shared, seen)
+            for k, v in obj.items()
+        )
+    else:
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            for name in slots:
+                if hasattr(obj, name):
+                    size += sizeof(getattr(obj, name), shared, seen)
+        if hasattr(obj, '__dict__'):
+            size += sizeof(obj.__dict__, shared, seen)
+    return size
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+from collections import Counter
+
+
+class Profiler:
+    # Profiles one request in `every` (0 turns sampling off) and every
+    # request of `session_id`. While a request is being profiled, the time
+    # between profiler events is charged to the current call stack, and the
+    # stacks are aggregated under the handler the request was dispatched to,
+    # in the collapsed format flamegraph tools read.
+    def __init__(self, every=0, session_id=None):
+        self.every = every
+        self.session_id = session_id
+        self.requests = 0
+        self.profiled = 0
+        self.stacks = Counter()
+
+        self._stack = []
+        self._samples = Counter()
+        self._last = 0
+
+    def wanted(self, session_id):
+        self.requests += 1
+        if self.session_id is not None and session_id == self.session_id:
+            return True
+        return bool(self.every) and self.requests % self.every == 0
+
+    def _charge(self):
+        now = time.perf_counter_ns()
+        self._samples[tuple(self._stack)] += now - self._last
+        self._last = now
+
+    def _event(self, frame, event, arg):
+        self._charge()
+        if event == 'call':
+            code = frame.f_code
+            self._stack.append(
+                f'{os.path.basename(code.co_filename)}:'
+                f'{getattr(code, "co_qualname", code.co_name)}')
+        elif event == 'c_call':
+            self._stack.append(getattr(arg, '__qualname__', repr(arg)))
+        elif self._stack:
+            self._stack.pop()
+
+    def call(self, func, *args):
+        # `func` must return the handler name first
+        self._stack = []
+        self._samples = Counter()
+        self._last = time.perf_counter_ns()
+        sys.setprofile(self._event)
+        try:
+            handler, *ret = func(*args)
+        finally:
+            sys.setprofile(None)
+            self._charge()
+            samples = self._samples
+            self._samples = Counter()
+
+        # the first frame is `func` itself, which is replaced by the handler
+        root = handler or 'unmatched'
+        for stack, ns in samples.items():
+            self.stacks[(root,) + stack[1:]] += ns
+        self.profiled += 1
+        return (handler, *ret)
+
+    def reset(self):
+        self.stacks.clear()
+        self.profiled = 0
+
+    def collapsed(self):
+        return ''.join(
+            f'{";".join(stack)} {ns // 1000}\n'
+            for stack, ns in self.stacks.most_common()
+            if ns >= 1000
+        )
@@ -0,0 +1,461 @@
+import random
+import logging
+import functools
+from collections import Counter, deque
+
+from rng import SessionRandom
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+# The original list-based engines, kept as the reference the optimized ones
+# in tetris.py, snake.py and twentyfortyeight.py are checked against. They
+# take the generator to draw from and pick free cells in row-major order,
+# like the optimized engines do, but are otherwise left as simple as they
+# were. Don't optimize them: being obviously right is their whole point.
+
+class TetrisField:
+    M = 22
+    N = 10
+
+    SHAPES = [
+        [
+            [0, 0, 2, 0],
+            [0, 0, 2, 0],
+            [0, 0, 2, 0],
+            [0, 0, 2, 0],
+        ],
+        [
+            [0, 3, 0],
+            [3, 3, 3],
+            [0, 0, 0],
+        ],
+        [
+            [4, 0, 0],
+            [4, 4, 4],
+            [0, 0, 0],
+        ],
+        [
+            [0, 0, 0],
+            [5, 5, 5],
+            [5, 0, 0],
+        ],
+        [
+            [0, 0, 0],
+            [0, 6, 6],
+            [6, 6, 0],
+        ],
+        [
+            [0, 0, 0],
+            [7, 7, 0],
+            [0, 7, 7],
+        ],
+        [
+            [8, 8],
+            [8, 8],
+        ],
+    ]
+
+    MOVES = ('left', 'right', 'rotate', 'step', 'multistep')
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self._table = [[0 for _ in range(self.N)] for _ in range(self.M)]
+        self.shape = self.rng.choice(self.SHAPES)
+        self.shape_i = 0
+        self.shape_j = 3
+
+    def check_fit(self, shape, shape_i, shape_j):
+        for i, row in enumerate(shape):
+            for j, el in enumerate(row):
+                global_i = i + shape_i
+                global_j = j + shape_j
+
+                if (shape[i][j] and (
+                        (not (0 <= global_i < self.M and 0 <= global_j < self.N))
+                        or self._table[global_i][global_j])):
+                    return False
+        return True
+
+    def apply(self):
+        for i in range(self.M):
+            for j in range(self.N):
+                shapelocal_i = i - self.shape_i
+                shapelocal_j = j - self.shape_j
+
+                if (0 <= shapelocal_i < len(self.shape)) and (0 <= shapelocal_j < len(self.shape[0])):
+                    assert not (self._table[i][j] and self.shape[shapelocal_i][shapelocal_j])
+                    self._table[i][j] = self._table[i][j] or self.shape[shapelocal_i][shapelocal_j]
+
+    def table(self):
+        ret = [[0 for _ in range(self.N)] for _ in range(self.M)]
+        for i in range(self.M):
+            for j in range(self.N):
+                shapelocal_i = i - self.shape_i
+                shapelocal_j = j - self.shape_j
+
+                if (0 <= shapelocal_i < len(self.shape)) and (0 <= shapelocal_j < len(self.shape[0])):
+                    assert not (self._table[i][j] and self.shape[shapelocal_i][shapelocal_j])
+                    ret[i][j] = ret[i][j] or self.shape[shapelocal_i][shapelocal_j]
+
+                ret[i][j] = ret[i][j] or self._table[i][j]
+
+        return ret
+
+    def _gravitate(self):
+        for i in range(self.M):
+            if all(self._table[i]):
+                self._table = (
+                    [[0 for _ in range(self.N)]]
+                    + self._table[:i]
+                    + self._table[i+1:]
+                )
+
+    def step(self):
+        self._gravitate()
+
+        if not self.check_fit(self.shape, self.shape_i + 1, self.shape_j):
+            self.apply()
+
+            self._gravitate()
+
+            self.shape = self.rng.choice(self.SHAPES)
+            self.shape_i = 0
+            self.shape_j = 3
+        else:
+            self.shape_i += 1
+
+    def multistep(self):
+        while True:
+            self._gravitate()
+
+            if not self.check_fit(self.shape, self.shape_i + 1, self.shape_j):
+                self.apply()
+
+                self._gravitate()
+
+                self.shape = self.rng.choice(self.SHAPES)
+                self.shape_i = 0
+                self.shape_j = 3
+                break
+            else:
+                self.shape_i += 1
+
+    def rotate(self):
+        rotated_shape = list(list(x) for x in zip(*self.shape))[::-1]
+        if self.check_fit(rotated_shape, self.shape_i, self.shape_j):
+            self.shape = rotated_shape
+
+    def left(self):
+        if self.check_fit(self.shape, self.shape_i, self.shape_j - 1):
+            self.shape_j -= 1
+
+    def right(self):
+        if self.check_fit(self.shape, self.shape_i, self.shape_j + 1):
+            self.shape_j += 1
+
+    def loss(self):
+        return any(self._table[3]) or any(self._table[2])
+
+
+class SnakeField:
+    N = 10
+
+    MOVES = ('up', 'down', 'left', 'right')
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self.walls = (
+            [(0, j) for j in range(self.N)] +
+            [(self.N-1, j) for j in range(self.N)] +
+            [(i, 0) for i in range(self.N)] +
+            [(i, self.N-1) for i in range(self.N)]
+        )
+
+        self.snake = deque()
+        self.snake = deque([self.random_space()])
+
+        self.food = self.random_space()
+
+        self.lost = False
+
+    def random_space(self):
+        free = [
+            (i, j) for i in range(self.N) for j in range(self.N)
+            if (i, j) not in self.snake and (i, j) not in self.walls
+        ]
+        if not free:
+            return None
+        return self.rng.choice(free)
+
+    def table(self):
+        ret = [[0 for _ in range(self.N)] for _ in range(self.N)]
+
+        for i, j in self.walls:
+            ret[i][j] = 1
+
+        for i, j in self.snake:
+            ret[i][j] = 2
+
+        if self.food is not None:
+            i, j = self.food
+            ret[i][j] = 3
+
+        if self.lost:
+            i, j = self.lost
+            ret[i][j] = 4
+
+        return ret
+
+    def check_free(self, i, j):
+        return not (
+            (i, j) in self.snake
+            or (i, j) in self.walls
+        )
+
+    def move(self, i, j):
+        if self.lost:
+            return
+        if self.check_free(i, j):
+            self.snake.appendleft((i, j))
+            if (i, j) == self.food:
+                self.food = self.random_space()
+            else:
+                self.snake.pop()
+        else:
+            self.lost = (i, j)
+
+    def loss(self):
+        return self.lost
+
+    def up(self):
+        i, j = self.snake[0]
+        self.move(i-1, j)
+
+    def down(self):
+        i, j = self.snake[0]
+        self.move(i+1, j)
+
+    def left(self):
+        i, j = self.snake[0]
+        self.move(i, j-1)
+
+    def right(self):
+        i, j = self.snake[0]
+        self.move(i, j+1)
+
+
+class TwentyFourtyEightField:
+    N = 4
+
+    MOVES = ('up', 'down', 'left', 'right')
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self._table = [[0 for _ in range(self.N)] for _ in range(self.N)]
+        self.spawn()
+
+    def free(self):
+        for i in range(self.N):
+            for j in range(self.N):
+                if not self._table[i][j]:
+                    yield i, j
+
+    def random_space(self):
+        return self.rng.choice(list(
+            self.free()
+        ))
+
+    def loss(self):
+        if any(self.free()):
+            return False
+        for i in range(self.N):
+            for j in range(self.N):
+                if j + 1 < self.N and self._table[i][j + 1] == self._table[i][j]:
+                    return False
+                if i + 1 < self.N and self._table[i + 1][j] == self._table[i][j]:
+                    return False
+        return True
+
+    def win(self):
+        return any([11 in row for row in self._table])
+
+    def spawn(self):
+        if not any(self.free()):
+            return
+        n = self.rng.choice([1, 2])
+        i, j = self.random_space()
+        self._table[i][j] = n
+
+    def collapse(self, l):
+        out_l = []
+
+        l = list(reversed(list(filter(None, l))))
+        while len(l) > 1:
+            if l[-1] == l[-2]:
+                out_l.append(l.pop() + 1)
+                l.pop()
+            else:
+                out_l.append(l.pop())
+        while len(l):
+            out_l.append(l.pop())
+
+        return out_l + [0] * (self.N - len(out_l))
+
+    def up(self):
+        table = [[0 for _ in range(self.N)] for _ in range(self.N)]
+
+        for i in range(self.N):
+            for j in range(self.N):
+                table[j][i] = self._table[i][j]
+
+        for i in range(self.N):
+            table[i] = self.collapse(table[i])
+
+        for i in range(self.N):
+            for j in range(self.N):
+                self._table[i][j] = table[j][i]
+
+        self.spawn()
+
+    def down(self):
+        table = [[0 for _ in range(self.N)] for _ in range(self.N)]
+
+        for i in range(self.N):
+            for j in range(self.N):
+                table[j][i] = self._table[i][j]
+
+        for i in range(self.N):
+            table[i] = list(reversed(self.collapse(list(reversed(table[i])))))
+
+        for i in range(self.N):
+            for j in range(self.N):
+                self._table[i][j] = table[j][i]
+
+        self.spawn()
+
+    def left(self):
+        for i in range(self.N):
+            self._table[i] = self.collapse(self._table[i])
+        self.spawn()
+
+    def right(self):
+        for i in range(self.N):
+            self._table[i] = list(reversed(self.collapse(list(reversed(self._table[i])))))
+        self.spawn()
+
+    def table(self):
+        return [list(row) for row in self._table]
+
+
+# engine class name -> reference
+REFERENCES = {
+    cls.__name__: cls
+    for cls in (TetrisField, SnakeField, TwentyFourtyEightField)
+}
+
+
+class Divergence(Exception):
+    pass
+
+
+def outcome(call):
+    # what a call returned, or the type of what it raised
+    try:
+        return call()
+    except Exception as e:
+        return type(e)
+
+
+class Lockstep:
+    # Stands in for an engine and repeats every move on a reference that
+    # started from the same generator state. After each move both boards and
+    # loss() are compared. A strict checker raises Divergence; otherwise the
+    # divergence is logged, the reference dropped and the engine goes on
+    # alone, which is what a live session needs.
+    __slots__ = ('engine', 'reference', 'strict', 'moves')
+
+    counters = Counter()
+
+    def __init__(self, engine, reference, strict=True):
+        self.engine = engine
+        self.reference = reference
+        self.strict = strict
+        self.moves = 0
+        self.counters['checked'] += 1
+        self.compare('start')
+
+    def __getattr__(self, name):
+        if name in Lockstep.__slots__:
+            # not set yet, while unpickling
+            raise AttributeError(name)
+        if self.reference is not None and name in self.reference.MOVES:
+            return functools.partial(self.move, name)
+        return getattr(self.engine, name)
+
+    def __setattr__(self, name, value):
+        if name in Lockstep.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.engine, name, value)
+
+    def unpack(self, data):
+        # the reference has no packed form to follow the engine back with
+        self.engine.unpack(data)
+        self.reference = None
+
+    def move(self, name):
+        try:
+            ret = getattr(self.engine, name)()
+        except Exception as e:
+            error = e
+        else:
+            error = None
+        expected = outcome(getattr(self.reference, name))
+        self.moves += 1
+        self.counters['moves'] += 1
+
+        if error is not None or isinstance(expected, type):
+            if type(error) is not expected:
+                self.diverge(f'{name} raised {error!r}, the reference {expected}')
+        else:
+            self.compare(name)
+
+        if error is not None:
+            raise error
+        return ret
+
+    def compare(self, name):
+        got = outcome(self.engine.table), bool(outcome(self.engine.loss))
+        expected = outcome(self.reference.table), bool(outcome(self.reference.loss))
+        if got != expected:
+            self.diverge(f'after {name} got {got}, the reference {expected}')
+
+    def diverge(self, message):
+        self.counters['diverged'] += 1
+        message = (
+            f'{type(self.engine).__name__} diverged from the reference'
+            f' after {self.moves} moves: {message}')
+        if self.strict:
+            raise Divergence(message)
+        logger.error(message)
+        self.reference = None
+
+
+def check(engine, seed):
+    # a strict checker for a fresh engine of class `engine`
+    return Lockstep(
+        engine(SessionRandom(seed)),
+        REFERENCES[engine.__name__](SessionRandom(seed)))
+
+
+def shadow(field, state):
+    # `field` was made from a generator in `state`; returns it unchanged if
+    # there is no reference for it
+    reference = REFERENCES.get(type(field).__name__)
+    if reference is None:
+        return field
+    rng = SessionRandom()
+    rng.setstate(state)
+    return Lockstep(field, reference(rng), strict=False)
@@ -0,0 +1,67 @@
+import os
+
+
+MASK = 2**64 - 1
+
+
+class SessionRandom:
+    # A splitmix64 generator with the subset of the random.Random interface
+    # the games use. random.Random carries 2.5 KB of Mersenne Twister state,
+    # which dwarfs everything else a session holds; this one is a single int.
+    __slots__ = ('state', 'tape')
+
+    def __init__(self, seed=None):
+        self.seed(seed)
+        # when set to a list, every raw draw is appended to it
+        self.tape = None
+
+    def seed(self, seed=None):
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), 'little')
+        self.state = seed & MASK
+
+    def getstate(self):
+        return self.state
+
+    def setstate(self, state):
+        self.state = state
+
+    def _next(self):
+        self.state = z = (self.state + 0x9E3779B97F4A7C15) & MASK
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK
+        z ^= z >> 31
+        if self.tape is not None:
+            self.tape.append(z)
+        return z
+
+    def getrandbits(self, k):
+        ret = 0
+        for shift in range(0, k, 64):
+            ret |= self._next() << shift
+        return ret & ((1 << k) - 1)
+
+    def random(self):
+        return (self._next() >> 11) * (1.0 / 2**53)
+
+    def _randbelow(self, n):
+        k = n.bit_length()
+        r = self.getrandbits(k)
+        while r >= n:
+            r = self.getrandbits(k)
+        return r
+
+    def randrange(self, start, stop=None):
+        if stop is None:
+            start, stop = 0, start
+        return start + self._randbelow(stop - start)
+
+    def choice(self, seq):
+        if not seq:
+            raise IndexError('Cannot choose from an empty sequence')
+        return seq[self._randbelow(len(seq))]
+
+    def shuffle(self, x):
+        for i in reversed(range(1, len(x))):
+            j = self._randbelow(i + 1)
+            x[i], x[j] = x[j], x[i]
@@ -0,0 +1,61 @@
+import os
+import sys
+import argparse
+import importlib.util
+
+import uvicorn
+
+
+def available(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the skill webhook.')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument(
+        '--workers', default=os.environ.get('WORKERS', '1'),
+        help='number of worker processes, or "auto" for one per CPU.'
+             ' Sessions live in worker memory, so more than one worker'
+             ' needs a balancer that keeps a session on the same worker.')
+    parser.add_argument(
+        '--keep-alive', type=int, default=int(os.environ.get('KEEP_ALIVE', 75)),
+        help='seconds to keep idle connections from the platform open')
+    parser.add_argument('--backlog', type=int, default=int(os.environ.get('BACKLOG', 4096)))
+    parser.add_argument(
+        '--graceful-timeout', type=int,
+        default=int(os.environ.get('GRACEFUL_TIMEOUT', 10)),
+        help='seconds to let in-flight requests finish on SIGTERM')
+    args = parser.parse_args()
+
+    if args.workers == 'auto':
+        workers = os.cpu_count() or 1
+    else:
+        workers = int(args.workers)
+    if workers > 1 and os.environ.get('JOURNAL_DIR'):
+        sys.exit('JOURNAL_DIR can only be used by a single worker')
+    if workers > 1 and os.environ.get('LEADERBOARD_PATH'):
+        sys.exit('LEADERBOARD_PATH can only be used by a single worker')
+    if workers > 1 and os.environ.get('SESSION_COLD_PATH'):
+        sys.exit('SESSION_COLD_PATH can only be used by a single worker')
+
+    # On SIGTERM uvicorn stops accepting connections, waits for in-flight
+    # requests for up to --graceful-timeout seconds and then runs the app's
+    # lifespan shutdown, which flushes the session journal.
+    uvicorn.run(
+        'main:app',
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop='uvloop' if available('uvloop') else 'asyncio',
+        http='httptools' if available('httptools') else 'h11',
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        access_log=False,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import os
+import time
+import pickle
+import asyncio
+import logging
+from collections import Counter, OrderedDict
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class SessionStore:
+    # Sessions by id, in two tiers. Sessions used in the last `idle_after`
+    # seconds stay in memory; older ones are pickled to the end of an
+    # append-only file, remembered by offset and length, and dropped from
+    # memory until their next request. Entries that have been read back are
+    # dead space, and the file is rewritten once that outweighs the live
+    # part. Without a `path` everything stays in memory, like a plain dict.
+    #
+    # The file is scratch space, not persistence: it is emptied on start,
+    # surviving restarts is what the journal is for.
+    def __init__(self, path=None, idle_after=300.0, batch=1000):
+        self.path = path
+        self.idle_after = idle_after
+        self.batch = batch
+
+        # session_id -> [machine, last used], least recently used first
+        self.hot = OrderedDict()
+        # session_id -> (offset, length) in the file
+        self.cold = {}
+        self.dead = 0
+
+        self.counters = Counter()
+        self.rehydrate_seconds = 0.0
+        self.max_rehydrate_seconds = 0.0
+
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'w+b')
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def __contains__(self, session_id):
+        return session_id in self.hot or session_id in self.cold
+
+    def __setitem__(self, session_id, machine):
+        self.hot[session_id] = [machine, time.monotonic()]
+        self.hot.move_to_end(session_id)
+
+    def __getitem__(self, session_id):
+        entry = self.hot.get(session_id)
+        if entry is not None:
+            self.counters['hits'] += 1
+            entry[1] = time.monotonic()
+            self.hot.move_to_end(session_id)
+            return entry[0]
+
+        offset, length = self.cold.pop(session_id)
+        started = time.perf_counter()
+        machine = pickle.loads(os.pread(self.file.fileno(), length, offset))
+        elapsed = time.perf_counter() - started
+        self.dead += length
+        self.counters['rehydrated'] += 1
+        self.rehydrate_seconds += elapsed
+        self.max_rehydrate_seconds = max(self.max_rehydrate_seconds, elapsed)
+
+        self[session_id] = machine
+        return machine
+
+    def restore(self, session_id, machine, idle):
+        # a session that has already been idle for `idle` seconds; restore
+        # the least recently used first, so they're evicted in order
+        self.hot[session_id] = [machine, time.monotonic() - idle]
+        self.hot.move_to_end(session_id)
+
+    def dump(self, session_id):
+        # the pickled session, or None; a cold one is copied from the file
+        # as it is, without bringing it back into memory
+        entry = self.hot.get(session_id)
+        if entry is not None:
+            return pickle.dumps(entry[0], pickle.HIGHEST_PROTOCOL)
+        if session_id in self.cold:
+            offset, length = self.cold[session_id]
+            return os.pread(self.file.fileno(), length, offset)
+        return None
+
+    def values(self):
+        # only the sessions in memory
+        return [machine for machine, _ in self.hot.values()]
+
+    def evict(self):
+        # moves up to `batch` idle sessions to the file, returns how many
+        if self.file is None:
+            return 0
+        deadline = time.monotonic() - self.idle_after
+        chunks = []
+        offset = self.file.seek(0, os.SEEK_END)
+        while self.hot and len(chunks) < self.batch:
+            session_id, (machine, last_used) = next(iter(self.hot.items()))
+            if last_used > deadline:
+                break
+            del self.hot[session_id]
+            data = pickle.dumps(machine, pickle.HIGHEST_PROTOCOL)
+            self.cold[session_id] = offset, len(data)
+            offset += len(data)
+            chunks.append(data)
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            self.counters['evicted'] += len(chunks)
+        if self.dead > max(offset - self.dead, 2**20):
+            self.compact()
+        return len(chunks)
+
+    def compact(self):
+        started = time.perf_counter()
+        fd = self.file.fileno()
+        with open(self.path + '.tmp', 'wb') as out:
+            cold = {}
+            for session_id, (offset, length) in self.cold.items():
+                cold[session_id] = out.tell(), length
+                out.write(os.pread(fd, length, offset))
+        os.replace(self.path + '.tmp', self.path)
+        self.file.close()
+        self.file = open(self.path, 'r+b')
+        self.cold = cold
+        self.dead = 0
+        self.counters['compactions'] += 1
+        logger.info(
+            f'session file compacted to {len(cold)} sessions'
+            f' in {1000 * (time.perf_counter() - started):.2f} ms')
+
+    async def run(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            # yield between batches so requests aren't held up for long
+            while self.evict() == self.batch:
+                await asyncio.sleep(0)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path)
+
+    def stats(self):
+        lookups = self.counters['hits'] + self.counters['rehydrated']
+        rehydrated = self.counters['rehydrated']
+        return {
+            'resident': len(self.hot),
+            'cold': len(self.cold),
+            'hit_ratio': round(self.counters['hits'] / lookups, 4) if lookups else None,
+            'avg_rehydrate_ms': round(
+                1000 * self.rehydrate_seconds / rehydrated, 3) if rehydrated else None,
+            'max_rehydrate_ms': round(1000 * self.max_rehydrate_seconds, 3),
+            'file_bytes': self.file.seek(0, os.SEEK_END) if self.file else 0,
+            'dead_bytes': self.dead,
+            **self.counters,
+        }
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from collections import Counter
+
+import reference
+from rng import SessionRandom, MASK
+from statemachine import EndSession
+from tetris import TetrisField
+from snake import SnakeField
+from twentyfortyeight import TwentyFourtyEightField
+from blackjack import Game21
+
+
+# Every game is played against the engine directly, without the webhook
+# around it. A play function returns (score, moves, how the game ended).
+
+TETRIS_MOVES = ('left', 'right', 'rotate', 'down')
+
+
+def play_tetris(field, policy, rng, max_moves):
+    for moves in range(max_moves):
+        if field.loss():
+            return field.lines, moves, 'topped out'
+        move = policy(field, rng)
+        if move == 'down':
+            field.multistep()
+        else:
+            getattr(field, move)()
+            field.step()
+    return field.lines, max_moves, 'move limit'
+
+
+SNAKE_MOVES = SnakeField.DIRECTIONS
+
+
+def play_snake(field, policy, rng, max_moves):
+    for moves in range(max_moves):
+        if field.food < 0:
+            return len(field.snake), moves, 'board filled'
+        move = policy(field, rng)
+        if move is None:
+            return len(field.snake), moves, 'no safe moves'
+        getattr(field, move)()
+        if field.loss():
+            i, j = divmod(field.lost, field.N)
+            edge = (0, field.N - 1)
+            cause = 'hit a wall' if i in edge or j in edge else 'bit itself'
+            return len(field.snake), moves + 1, cause
+    return len(field.snake), max_moves, 'move limit'
+
+
+MOVES_2048 = ('up', 'down', 'left', 'right')
+
+
+def play_2048(field, policy, rng, max_moves):
+    for moves in range(1, max_moves + 1):
+        getattr(field, policy(field, rng))()
+        if field.loss():
+            return field.max_tile(), moves, 'no moves'
+        if field.win():
+            return field.max_tile(), moves, 'won'
+    return field.max_tile(), max_moves, 'move limit'
+
+
+def play_blackjack(game, policy, rng, max_moves):
+    game.start()
+    moves = 0
+    try:
+        while True:
+            moves += 1
+            if policy(game, rng) == 'enough':
+                game.enough()
+            game.pick()
+    except EndSession as e:
+        value = game.hand_value()
+        if value == 21:
+            cause = 'twenty-one'
+        elif value > 21:
+            cause = 'bust'
+        elif e.resp.text.startswith('Вы выиграли'):
+            cause = 'beat the dealer'
+        else:
+            cause = 'lost to the dealer'
+        return value, moves, cause
+
+
+def random_move(moves):
+    def policy(field, rng):
+        return rng.choice(moves)
+    return policy
+
+
+def snake_hint(field, rng):
+    return field.hint()
+
+
+def blackjack_random(game, rng):
+    return 'pick' if rng.random() < 0.5 else 'enough'
+
+
+def blackjack_chances(game, rng):
+    value = game.hand_value()
+    counts = game.value_counts()
+    stand, hit = game.win_chances(value, counts)
+    if hit > stand:
+        return 'pick'
+    return 'enough'
+
+
+# game -> (engine, play function, policies)
+GAMES = {
+    'tetris': (TetrisField, play_tetris, {
+        'random': random_move(TETRIS_MOVES),
+    }),
+    'snake': (SnakeField, play_snake, {
+        'random': random_move(SNAKE_MOVES),
+        'hint': snake_hint,
+    }),
+    '2048': (TwentyFourtyEightField, play_2048, {
+        'random': random_move(MOVES_2048),
+    }),
+    'blackjack': (Game21, play_blackjack, {
+        'random': blackjack_random,
+        'hint': blackjack_chances,
+    }),
+}
+
+
+def play(game, policy, seed, max_moves, check=False):
+    # the engine and the policy draw from separate generators, so the same
+    # seed deals the same game whatever the policy does with its own draws
+    engine, play_game, policies = GAMES[game]
+    if check:
+        field = reference.check(engine, seed)
+    else:
+        field = engine(SessionRandom(seed))
+    return play_game(
+        field, policies[policy], SessionRandom(~seed & MASK), max_moves)
+
+
+class Stats:
+    __slots__ = ('games', 'moves', 'seconds', 'scores', 'lengths', 'causes', 'seeds')
+
+    def __init__(self):
+        self.games = 0
+        self.moves = 0
+        # time spent inside the engines and policies, summed over workers
+        self.seconds = 0.0
+        self.scores = Counter()
+        self.lengths = Counter()
+        self.causes = Counter()
+        # cause -> seed of the first game that ended that way
+        self.seeds = {}
+
+    def add(self, score, moves, cause, seed):
+        self.games += 1
+        self.moves += moves
+        self.scores[score] += 1
+        self.lengths[moves] += 1
+        self.causes[cause] += 1
+        self.seeds.setdefault(cause, seed)
+
+    def merge(self, other):
+        self.games += other.games
+        self.moves += other.moves
+        self.seconds += other.seconds
+        self.scores.update(other.scores)
+        self.lengths.update(other.lengths)
+        self.causes.update(other.causes)
+        for cause, seed in other.seeds.items():
+            self.seeds.setdefault(cause, seed)
+
+    def us_per_move(self):
+        return 1e6 * self.seconds / max(self.moves, 1)
+
+    def summary(self):
+        return {
+            'games': self.games,
+            'moves': self.moves,
+            'us_per_move': round(self.us_per_move(), 3),
+            'score': distribution(self.scores),
+            'length': distribution(self.lengths),
+            'causes': dict(self.causes.most_common()),
+            'seeds': self.seeds,
+        }
+
+
+def percentile(counts, total, q):
+    rank = q * (total - 1)
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen > rank:
+            return value
+
+
+def distribution(counts):
+    total = sum(counts.values())
+    if not total:
+        return {}
+    return {
+        'mean': round(sum(v * n for v, n in counts.items()) / total, 3),
+        'min': min(counts),
+        'p50': percentile(counts, total, 0.5),
+        'p90': percentile(counts, total, 0.9),
+        'p99': percentile(counts, total, 0.99),
+        'max': max(counts),
+    }
+
+
+def run_batch(args):
+    game, policy, batch_seed, games, max_moves, check = args
+    seeds = SessionRandom(batch_seed)
+    stats = Stats()
+    started = time.perf_counter()
+    for _ in range(games):
+        seed = seeds.getrandbits(64)
+        try:
+            score, moves, cause = play(game, policy, seed, max_moves, check)
+        except Exception as e:
+            # engine bugs are a result too; the seed reproduces them
+            score, moves, cause = None, 0, f'error: {type(e).__name__}'
+            stats.seeds.setdefault(cause, seed)
+            if cause not in stats.causes:
+                traceback.print_exc()
+        stats.add(score, moves, cause, seed)
+    stats.seconds = time.perf_counter() - started
+    stats.scores.pop(None, None)
+    return stats
+
+
+def batches(args):
+    # batches are seeded by number, so the results don't depend on which
+    # worker happens to pick up which batch
+    left = args.games
+    n = 0
+    while left > 0:
+        size = min(args.batch, left)
+        yield (args.game, args.policy, (args.seed << 32) + n, size,
+               args.max_moves, args.check)
+        left -= size
+        n += 1
+
+
+def report(stats, total, elapsed):
+    score = distribution(stats.scores)
+    causes = ', '.join(
+        f'{cause} {100 * n / stats.games:.1f}%'
+        for cause, n in stats.causes.most_common())
+    print(
+        f'{stats.games}/{total} games, {stats.games / elapsed:.0f} games/s,'
+        f' {stats.us_per_move():.2f} us/move, mean score {score.get("mean")},'
+        f' {causes}',
+        file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Play games headlessly and collect statistics.')
+    parser.add_argument('game', choices=GAMES)
+    parser.add_argument('--policy', default='random')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='number of worker processes')
+    parser.add_argument('--batch', type=int, default=1000, help='games per task')
+    parser.add_argument(
+        '--seed', type=int,
+        help='seed of the whole run; random if not given')
+    parser.add_argument(
+        '--max-moves', type=int, default=10000,
+        help='games still going after this many moves are stopped')
+    parser.add_argument(
+        '--report-every', type=float, default=5.0,
+        help='seconds between progress lines on stderr')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='play every move on the reference engine too and compare the'
+             ' boards; a mismatch ends the game as "error: Divergence"')
+    parser.add_argument(
+        '--replay', type=int, metavar='SEED',
+        help='play the single game with this seed, letting errors through')
+    args = parser.parse_args()
+
+    if args.policy not in GAMES[args.game][2]:
+        parser.error(
+            f'{args.game} has no {args.policy!r} policy,'
+            f' choose from {", ".join(GAMES[args.game][2])}')
+    if args.check and GAMES[args.game][0].__name__ not in reference.REFERENCES:
+        parser.error(f'{args.game} has no reference engine to check against')
+
+    if args.replay is not None:
+        score, moves, cause = play(
+            args.game, args.policy, args.replay, args.max_moves, args.check)
+        print(json.dumps({'score': score, 'moves': moves, 'cause': cause}))
+        return
+
+    if args.seed is None:
+        args.seed = int.from_bytes(os.urandom(4), 'little')
+    print(f'seed {args.seed}', file=sys.stderr)
+
+    stats = Stats()
+    started = last = time.perf_counter()
+    with multiprocessing.Pool(args.workers) as pool:
+        for batch in pool.imap_unordered(run_batch, batches(args)):
+            stats.merge(batch)
+            now = time.perf_counter()
+            if now - last >= args.report_every:
+                report(stats, args.games, now - started)
+                last = now
+    elapsed = time.perf_counter() - started
+    report(stats, args.games, elapsed)
+
+    summary = stats.summary()
+    summary.update(
+        game=args.game, policy=args.policy, seed=args.seed,
+        workers=args.workers, seconds=round(elapsed, 3),
+        games_per_second=round(stats.games / elapsed, 1),
+    )
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
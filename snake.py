@@ -1,100 +1,350 @@
 import random
+import struct
+from array import array
 from collections import deque
 
+from grid import Grid
+from history import History
+from content import packs
+from statemachine import StateMachine, EndSession, GAME_OVER, NOTHING_TO_UNDO
+
+
+FREE = 0
+WALL = 1
+BODY = 2
+FOOD = 3
+CRASH = 4
+
+
+class SearchBuffers:
+    # Scratch space for hint(). Requests are handled one at a time, so all
+    # fields of the same size share a single set of buffers.
+    __slots__ = ('vacate', 'seen', 'dist', 'first', 'queue', 'stamp')
+
+    def __init__(self, size):
+        self.vacate = array('I', bytes(4 * size))
+        self.seen = array('I', bytes(4 * size))
+        self.dist = array('I', bytes(4 * size))
+        self.first = bytearray(size)
+        self.queue = array('I', bytes(4 * size))
+        self.stamp = 0
+
 
 class SnakeField:
     N = 10
 
-    def __init__(self):
-        self.walls = (
-            [(0, j) for j in range(self.N)] +
-            [(self.N-1, j) for j in range(self.N)] +
-            [(i, 0) for i in range(self.N)] +
-            [(i, self.N-1) for i in range(self.N)]
-        )
+    EMOJI = ('⬜', '⬛', '🟩', '🟨', '🟥')
+    BW_EMOJI = ('⬜', '⬛', '🐍', '🔴', '💥')
+    PALETTES = {'default': EMOJI, 'bw': BW_EMOJI}
+
+    _buffers = {}
+
+    __slots__ = ('rng', '_grid', 'snake', 'food', 'emoji_', 'lost')
+
+    def __init__(self, rng=None, palette='default'):
+        self.rng = rng or random.Random()
+
+        # cells are numbered i * N + j
+        self._grid = Grid(self.N, self.N)
+        for k in range(self.N):
+            self._grid.put(0, k, WALL)
+            self._grid.put(self.N-1, k, WALL)
+            self._grid.put(k, 0, WALL)
+            self._grid.put(k, self.N-1, WALL)
 
-        self.snake = deque()
         self.snake = deque([self.random_space()])
+        self._grid[self.snake[0]] = BODY
 
         self.food = self.random_space()
+        if self.food >= 0:
+            self._grid[self.food] = FOOD
 
-        self.emoji_ = ['⬜', '⬛', '🟩', '🟨', '🟥']
-        self.lost = False
+        self.emoji_ = self.PALETTES[palette]
+        self.lost = None
 
-    def random_space(self):
-        try:
-            return random.choice(list(
-                {(i, j) for i in range(self.N) for j in range(self.N)}
-                - set(self.snake)
-                - set(self.walls)
-            ))
-        except IndexError:
-            return -5, -5
+    # food and crash cells, or -1; the board and the snake head first follow
+    HEADER = struct.Struct('<hh')
 
-    def table(self):
-        ret = [[0 for _ in range(self.N)] for _ in range(self.N)]
+    def pack(self):
+        return (
+            self.HEADER.pack(self.food, -1 if self.lost is None else self.lost)
+            + bytes(self._grid.cells) + array('H', self.snake).tobytes()
+        )
 
-        for i, j in self.walls:
-            ret[i][j] = 1
+    def unpack(self, data):
+        self.food, lost = self.HEADER.unpack_from(data)
+        self.lost = None if lost < 0 else lost
+        end = self.HEADER.size + self.N * self.N
+        self._grid.load(data[self.HEADER.size:end])
+        self.snake = deque(array('H', data[end:]))
 
-        for i, j in self.snake:
-            ret[i][j] = 2
+    def palette(self):
+        return next(name for name, emoji in self.PALETTES.items() if emoji is self.emoji_)
 
-        i, j = self.food
-        ret[i][j] = 3
+    def __getstate__(self):
+        return self.rng, self.palette(), self.pack()
 
-        if self.lost:
-            i, j = self.lost
-            ret[i][j] = 4
+    def __setstate__(self, state):
+        self.rng, palette, data = state
+        self._grid = Grid(self.N, self.N)
+        self.emoji_ = self.PALETTES[palette]
+        self.unpack(data)
 
-        return ret
+    def random_space(self):
+        # free cells are listed in row-major order, so a seeded generator
+        # always picks the same cell
+        free = [k for k, kind in enumerate(self._grid.cells) if kind == FREE]
+        if not free:
+            return -1
+        return self.rng.choice(free)
 
-    def check_free(self, i, j):
-        return not (
-            (i, j) in self.snake
-            or (i, j) in self.walls
-        )
+    def table(self):
+        return self._grid.table()
 
-    def move(self, i, j):
-        if self.lost:
+    def check_free(self, cell):
+        return self._grid[cell] in (FREE, FOOD)
+
+    def move(self, cell):
+        if self.lost is not None:
             return
-        if self.check_free(i, j):
-            self.snake.appendleft((i, j))
-            if (i, j) == self.food:
+        if self.check_free(cell):
+            self.snake.appendleft(cell)
+            self._grid[cell] = BODY
+            if cell == self.food:
                 self.food = self.random_space()
+                if self.food >= 0:
+                    self._grid[self.food] = FOOD
             else:
-                self.snake.pop()
+                self._grid[self.snake.pop()] = FREE
         else:
-            self.lost = (i, j)
+            self.lost = cell
+            self._grid[cell] = CRASH
 
     def loss(self):
-        return self.lost
+        return self.lost is not None
 
     def up(self):
-        i, j = self.snake[0]
-        self.move(i-1, j)
+        self.move(self.snake[0] - self.N)
 
     def down(self):
-        i, j = self.snake[0]
-        self.move(i+1, j)
+        self.move(self.snake[0] + self.N)
 
     def left(self):
-        i, j = self.snake[0]
-        self.move(i, j-1)
+        self.move(self.snake[0] - 1)
 
     def right(self):
-        i, j = self.snake[0]
-        self.move(i, j+1)
+        self.move(self.snake[0] + 1)
+
+    DIRECTIONS = ('up', 'down', 'left', 'right')
+
+    def _steps(self):
+        return (-self.N, self.N, -1, 1)
+
+    def _search_buffers(self):
+        try:
+            return self._buffers[self.N]
+        except KeyError:
+            buffers = self._buffers[self.N] = SearchBuffers(self.N * self.N)
+            return buffers
+
+    def _next_stamp(self, buffers):
+        buffers.stamp += 1
+        if buffers.stamp == 2**32:
+            buffers.stamp = 1
+            for k in range(len(buffers.seen)):
+                buffers.seen[k] = 0
+        return buffers.stamp
+
+    def _enterable(self, buffers, cell, d):
+        # a body cell may be entered once the tail has moved off it,
+        # `vacate` holds the number of moves after which that happens
+        kind = self._grid[cell]
+        return kind in (FREE, FOOD) or (kind == BODY and d > buffers.vacate[cell])
+
+    def _search(self, buffers, starts):
+        # breadth-first search from the cells in `starts`, which must already
+        # be marked as seen and have their `dist` and `first` filled in
+        seen = buffers.seen
+        dist = buffers.dist
+        first = buffers.first
+        queue = buffers.queue
+        stamp = buffers.stamp
+        steps = self._steps()
+
+        tail = 0
+        for cell in starts:
+            queue[tail] = cell
+            tail += 1
+        head = 0
+        while head < tail:
+            cell = queue[head]
+            head += 1
+            d = dist[cell] + 1
+            for step in steps:
+                nxt = cell + step
+                if seen[nxt] == stamp or not self._enterable(buffers, nxt, d):
+                    continue
+                seen[nxt] = stamp
+                dist[nxt] = d
+                first[nxt] = first[cell]
+                queue[tail] = nxt
+                tail += 1
+        return tail
+
+    def _start(self, buffers, head, moves):
+        stamp = self._next_stamp(buffers)
+        buffers.seen[head] = stamp
+        steps = self._steps()
+        for k in moves:
+            cell = head + steps[k]
+            buffers.seen[cell] = stamp
+            buffers.dist[cell] = 1
+            buffers.first[cell] = k
+        return [head + steps[k] for k in moves]
+
+    def hint(self):
+        if self.lost is not None:
+            return None
+
+        buffers = self._search_buffers()
+        length = len(self.snake)
+        for k, cell in enumerate(self.snake):
+            buffers.vacate[cell] = length - k
+
+        head = self.snake[0]
+        moves = [
+            k for k, step in enumerate(self._steps())
+            if self._enterable(buffers, head + step, 1)
+        ]
+        if not moves:
+            return None
+
+        if self.food >= 0:
+            self._search(buffers, self._start(buffers, head, moves))
+            if buffers.seen[self.food] == buffers.stamp:
+                return self.DIRECTIONS[buffers.first[self.food]]
+
+        # no way to the food, pick the move with the most room to survive
+        best, best_room = moves[0], -1
+        for k in moves:
+            room = self._search(buffers, self._start(buffers, head, [k]))
+            if room > best_room:
+                best, best_room = k, room
+        return self.DIRECTIONS[best]
 
     def print(self):
-        for row in self.table():
-            print(''.join(str(n) for n in row))
+        self._grid.print()
 
     def emoji(self):
-        table = self.table()
+        return '\n'.join(self._grid.render(self.emoji_))
+
+
+class Snake(StateMachine):
+    __slots__ = ('field', 'history', 'palette')
+
+    similar = {
+        'налево': ['лево', 'влево'],
+        'направо': ['право', 'вправо'],
+        'вниз': ['низ'],
+        'вверх': ['верх'],
+        'отмена': ['отменить', 'отмени'],
+    }
+
+    # the texts are in content/snake.json
+    PACK = 'snake'
+    # the texts it needs, with the values they're filled in with
+    TEXTS = {
+        'start': ('board',),
+        'hint': ('direction',),
+        'no_moves': (),
+        'lost': ('board',),
+    }
+
+    # moves that can be taken back
+    UNDO_DEPTH = 5
+
+    PALETTES = SnakeField.PALETTES
+
+    def __init__(self, rng=None, palette='default'):
+        super().__init__(rng)
+        self.palette = palette
+
+    def start(self):
+        self.field = SnakeField(self.rng, self.palette)
+        self.history = History(self.UNDO_DEPTH)
+        return packs.get(self.PACK).text('start', board=(self.field.emoji(), ''))
+
+    def score(self):
+        return len(self.field.snake)
+
+    @StateMachine.input({'плитки'})
+    def bw_emoji(self):
+        self.field.emoji_ = self.field.BW_EMOJI
+        return self.field.emoji()
+
+    # the commands, so these stay with the handlers rather than in the pack
+    HINTS = {
+        'up': 'вверх',
+        'down': 'вниз',
+        'left': 'налево',
+        'right': 'направо',
+    }
+
+    @StateMachine.input({'подсказка'})
+    def hint(self):
+        direction = self.field.hint()
+        if direction is None:
+            return packs.get(self.PACK).text('no_moves')
+        return packs.get(self.PACK).text('hint', direction=self.HINTS[direction])
+
+    @StateMachine.input({'налево'})
+    def left(self):
+        self.history.push(self.field.pack())
+        self.field.left()
+        ret = self.field.emoji()
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=ret))
+        return ret
+
+    @StateMachine.input({'направо'})
+    def right(self):
+        self.history.push(self.field.pack())
+        self.field.right()
+        ret = self.field.emoji()
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=ret))
+        return ret
+
+    @StateMachine.input({'вверх'})
+    def up(self):
+        self.history.push(self.field.pack())
+        self.field.up()
+        ret = self.field.emoji()
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=ret))
+        return ret
+
+    @StateMachine.input({'вниз'})
+    def down(self):
+        self.history.push(self.field.pack())
+        self.field.down()
+        ret = self.field.emoji()
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=ret))
+        return ret
+
+    @StateMachine.input({'отмена'})
+    def undo(self):
+        snapshot = self.history.pop()
+        if snapshot is None:
+            return NOTHING_TO_UNDO
+        self.field.unpack(snapshot)
+        return self.field.emoji()
+
+    @StateMachine.input({'достаточно'})
+    @StateMachine.input({'выйти'})
+    def enough(self):
+        raise EndSession(GAME_OVER)
 
-        for i in range(self.N):
-            for j in range(self.N):
-                table[i][j] = self.emoji_[table[i][j]]
 
-        return '\n'.join(''.join(e for e in row) for row in table)
+packs.require(Snake.PACK, Snake.TEXTS)
@@ -0,0 +1,212 @@
+import re
+import json
+import logging
+
+from rng import SessionRandom
+from fuzzy import Trie
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def countable(n, one, few, many):
+    if n % 10 == 1:
+        return f'{n} {one}'
+    if n % 10 in {2, 3, 4}:
+        return f'{n} {few}'
+    return f'{n} {many}'
+
+
+###
+
+class Response:
+    def __init__(self, text, tts=None, buttons=[], cards={}):
+        self.text = text
+        self.tts = to_tts(tts or text)
+        self.buttons = buttons
+        self.cards = cards
+
+    def json(self):
+        ret = {
+            'text': self.text,
+            'tts': self.tts,
+            'end_session': False
+        }
+        if self.buttons:
+            ret['buttons'] = [{'title': b} for b in self.buttons]
+        if self.cards:
+            ret['commands'] = self.cards
+        return ret
+
+
+class StaticResponse(Response):
+    # A reply that never changes, encoded to JSON once. Only the session
+    # and version are filled in per request.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.body = dumps(self.json())
+
+
+def dumps(obj):
+    # same encoding as FastAPI's JSONResponse
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def to_tts(s):
+    if '{' not in s:
+        return s
+    return re.sub('{.*?}{(.*?)}', r'\1', s)
+
+
+class EndSession(Exception):
+    def __init__(self, *args, **kwargs):
+        if len(args) == 1 and isinstance(args[0], Response):
+            self.resp = args[0]
+        else:
+            self.resp = Response(*args, **kwargs)
+
+
+GAME_OVER = StaticResponse('Игра закончена.')
+UNRECOGNISED = StaticResponse('Команда не распознана')
+NOTHING_TO_UNDO = StaticResponse('Отменять больше нечего.')
+
+
+def is_similar(cls, a, b):
+    def collate(s):
+        return cls._collate.get(s, s)
+    return collate(a.casefold()) == collate(b.casefold())
+
+
+class StateMachine:
+    _collate = {}
+    _vocabulary = Trie()
+    # (name, method) of every handler, in the order they are tried
+    _handlers = ()
+
+    similar = {}
+
+    __slots__ = ('state', 'rng', '_inhabited_by', 'inhabitor')
+
+    def __init_subclass__(cls, /, handlers=(), **kwargs):
+        # `handlers` are (name, method) pairs made outside the class body,
+        # added to the class and tried before the ones defined in it
+        super().__init_subclass__(**kwargs)
+        handlers = tuple(handlers)
+        for name, method in handlers:
+            setattr(cls, name, method)
+        names = {name for name, _ in handlers}
+        cls._handlers = handlers + tuple(
+            (name, method) for name, method in cls.__dict__.items()
+            if hasattr(method, '_matches') and name not in names)
+
+        words = set()
+        for best, good in cls.similar.items():
+            words.add(best)
+            for alias in good:
+                cls._collate[alias] = best
+                words.add(alias)
+
+        # every token the handlers of this class are declared with, so that
+        # misrecognised ones can be mapped back onto them
+        for _, method in cls._handlers:
+            for matches in method._matches:
+                if isinstance(matches.match_spec, (set, list)):
+                    words.update(word.casefold() for word in matches.match_spec)
+        cls._vocabulary = Trie(words)
+
+    def input(match_spec=None):
+        def matches(cls, command, tokens):
+            #print(match_spec)
+            if match_spec is None:
+                return True
+            elif isinstance(match_spec, list):
+                return len(match_spec) == len(tokens) and all(
+                    is_similar(cls, a, b)
+                    for a, b in zip(match_spec, tokens)
+                )
+            elif isinstance(match_spec, str):
+                return is_similar(cls, match_spec, command)
+            elif isinstance(match_spec, set):
+                return all(
+                    any(
+                        is_similar(cls, required, present)
+                        for present in tokens)
+                    for required in match_spec
+                )
+
+        matches.match_spec = match_spec
+
+        def decorator(func):
+            if not hasattr(func, '_matches'):
+                func._matches = []
+            func._matches.append(matches)
+            return func
+
+        return decorator
+
+    def need_state(*state):
+        def decorator(func):
+            func._need_state = state
+            return func
+
+        return decorator
+
+    def dispatch(self, request):
+        # name of the handler, as 'Class.method', that `run` should call
+        if self._inhabited_by is not None:
+            return self._inhabited_by.dispatch(request)
+        logger.info(f'dispatching request {request}')
+        command = request.command
+        tokens = [type(self)._vocabulary.correct(token) for token in request.nlu.tokens]
+        for name, method in type(self)._handlers:
+            if hasattr(method, '_matches'):
+                logger.info(f'testing method {name}')
+                if any(matches(type(self), command, tokens)
+                       for matches in method._matches):
+                    logger.info('input matches')
+                    if ((not hasattr(method, '_need_state'))
+                            or self.state in method._need_state):
+                        logger.info('state correct. matched.')
+                    else:
+                        logger.info('state incorrect')
+                else:
+                    logger.info("input doesn't match")
+            if (
+                    hasattr(method, '_matches')
+                    and any(
+                        matches(type(self), command, tokens)
+                        for matches in method._matches)
+                    and ((not hasattr(method, '_need_state'))
+                         or self.state in method._need_state)):
+                return f'{type(self).__name__}.{name}'
+        return None
+
+    def run(self, handler):
+        if self._inhabited_by is not None:
+            try:
+                return self._inhabited_by.run(handler)
+            except EndSession as e:
+                self._inhabited_by = None
+                return e.resp
+        if handler is None:
+            return UNRECOGNISED
+        cls, name = handler.split('.')
+        assert cls == type(self).__name__
+        return getattr(self, name)()
+
+    def score(self):
+        # what the game so far is worth on the leaderboard, None if nothing
+        return None
+
+    def parse(self, request):
+        return self.run(self.dispatch(request))
+
+    def inhabit(self, state_machine):
+        assert self._inhabited_by is None
+        state_machine.inhabitor = self
+        self._inhabited_by = state_machine
+
+    def __init__(self, rng=None):
+        self.state = None
+        self.rng = rng or SessionRandom()
+        self._inhabited_by = None
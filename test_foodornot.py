@@ -0,0 +1,23 @@
+from main import Greeter, Request, Nlu, replay
+from statemachine import UNRECOGNISED
+
+
+def request(text):
+    return Request(
+        command=text, original_utterance=text, type='SimpleUtterance',
+        nlu=Nlu(tokens=text.split()))
+
+
+def test_short_words_are_not_taken_for_answers():
+    for phrase in ('ну дай подумать', 'дам', 'тем более'):
+        _, resp = replay(1, [request('съедобно'), request(phrase)])
+        assert resp is UNRECOGNISED, phrase
+
+
+def test_typos_are_still_answers():
+    _, resp = replay(1, [request('съедобно'), request('выброщу')])
+    assert resp is not UNRECOGNISED
+
+
+def test_similar_words_are_whole_words():
+    assert all(len(word) > 1 for word in Greeter._vocabulary.words)
@@ -1,4 +1,10 @@
 import random
+import struct
+
+from grid import Grid, render_row
+from history import History
+from content import packs
+from statemachine import StateMachine, EndSession, GAME_OVER, NOTHING_TO_UNDO
 
 
 def grouper(iterable, n):
@@ -12,50 +18,84 @@ N = 10
 
 
 class TetrisField:
-    SHAPES = [
-        [
-            [0, 0, 2, 0],
-            [0, 0, 2, 0],
-            [0, 0, 2, 0],
-            [0, 0, 2, 0],
-        ],
-        [
-            [0, 3, 0],
-            [3, 3, 3],
-            [0, 0, 0],
-        ],
-        [
-            [4, 0, 0],
-            [4, 4, 4],
-            [0, 0, 0],
-        ],
-        [
-            [0, 0, 0],
-            [5, 5, 5],
-            [5, 0, 0],
-        ],
-        [
-            [0, 0, 0],
-            [0, 6, 6],
-            [6, 6, 0],
-        ],
-        [
-            [0, 0, 0],
-            [7, 7, 0],
-            [0, 7, 7],
-        ],
-        [
-            [8, 8],
-            [8, 8],
-        ],
-    ]
-
-    def __init__(self):
-        self._table = [[0 for _ in range(N)] for _ in range(M)]
-        self.shape = random.choice(self.SHAPES)
+    SHAPES = (
+        (
+            (0, 0, 2, 0),
+            (0, 0, 2, 0),
+            (0, 0, 2, 0),
+            (0, 0, 2, 0),
+        ),
+        (
+            (0, 3, 0),
+            (3, 3, 3),
+            (0, 0, 0),
+        ),
+        (
+            (4, 0, 0),
+            (4, 4, 4),
+            (0, 0, 0),
+        ),
+        (
+            (0, 0, 0),
+            (5, 5, 5),
+            (5, 0, 0),
+        ),
+        (
+            (0, 0, 0),
+            (0, 6, 6),
+            (6, 6, 0),
+        ),
+        (
+            (0, 0, 0),
+            (7, 7, 0),
+            (0, 7, 7),
+        ),
+        (
+            (8, 8),
+            (8, 8),
+        ),
+    )
+
+    EMOJI = ('⬜', '⬛', '🟥', '🟧', '🟨', '🟩', '🟦', '🟪', '🟫')
+    BW_EMOJI = ('⬜', '⬛', '⬛', '⬛', '⬛', '⬛', '⬛', '⬛', '⬛')
+    PALETTES = {'default': EMOJI, 'bw': BW_EMOJI}
+
+    __slots__ = ('rng', '_table', 'shape', 'shape_i', 'shape_j', 'emoji_', 'lines')
+
+    def __init__(self, rng=None, palette='default'):
+        self.rng = rng or random.Random()
+        self._table = Grid(M, N)
+        self.shape = self.rng.choice(self.SHAPES)
         self.shape_i = 0
         self.shape_j = 3
-        self.emoji_ = ['⬜', '⬛', '🟥', '🟧', '🟨', '🟩', '🟦', '🟪', '🟫']
+        self.emoji_ = self.PALETTES[palette]
+        # rows cleared so far
+        self.lines = 0
+
+    # shape, its row and column, cleared rows; the board follows
+    HEADER = struct.Struct('<BbbI')
+
+    def pack(self):
+        return self.HEADER.pack(
+            SHAPE_IDS[self.shape], self.shape_i, self.shape_j, self.lines,
+        ) + bytes(self._table.cells)
+
+    def unpack(self, data):
+        shape, self.shape_i, self.shape_j, self.lines = self.HEADER.unpack_from(data)
+        self.shape = ALL_SHAPES[shape]
+        self._table.load(data[self.HEADER.size:])
+
+    def palette(self):
+        return next(name for name, emoji in self.PALETTES.items() if emoji is self.emoji_)
+
+    def __getstate__(self):
+        return self.rng, self.palette(), self.pack()
+
+    def __setstate__(self, state):
+        self.rng, palette, data = state
+        self._table = Grid(M, N)
+        self.emoji_ = self.PALETTES[palette]
+        self.unpack(data)
 
     def check_fit(self, shape, shape_i, shape_j):
         for i, row in enumerate(shape):
@@ -63,47 +103,36 @@ class TetrisField:
                 global_i = i + shape_i
                 global_j = j + shape_j
 
-                if (shape[i][j] and (
+                if (el and (
                         (not (0 <= global_i < M and 0 <= global_j < N))
-                        or self._table[global_i][global_j])):
+                        or self._table.at(global_i, global_j))):
                     return False
         return True
 
     def apply(self):
-        for i in range(M):
-            for j in range(N):
-                shapelocal_i = i - self.shape_i
-                shapelocal_j = j - self.shape_j
-
-                if (0 <= shapelocal_i < len(self.shape)) and (0 <= shapelocal_j < len(self.shape[0])):
-                    assert not (self._table[i][j] and self.shape[shapelocal_i][shapelocal_j])
-                    self._table[i][j] = self._table[i][j] or self.shape[shapelocal_i][shapelocal_j]
+        for i, row in enumerate(self.shape):
+            for j, el in enumerate(row):
+                if el:
+                    assert not self._table.at(i + self.shape_i, j + self.shape_j)
+                    self._table.put(i + self.shape_i, j + self.shape_j, el)
 
     def table(self):
-        ret = [[0 for _ in range(N)] for _ in range(M)]
-        for i in range(M):
-            for j in range(N):
-                #print('g', i, j, self._table[i][j])
-                shapelocal_i = i - self.shape_i
-                shapelocal_j = j - self.shape_j
-
-                if (0 <= shapelocal_i < len(self.shape)) and (0 <= shapelocal_j < len(self.shape[0])):
-                    #print('l', shapelocal_i, shapelocal_j, self.shape[shapelocal_i][shapelocal_j])
-                    assert not (self._table[i][j] and self.shape[shapelocal_i][shapelocal_j])
-                    ret[i][j] = ret[i][j] or self.shape[shapelocal_i][shapelocal_j]
-
-                ret[i][j] = ret[i][j] or self._table[i][j]
+        ret = self._table.table()
+        for i, row in enumerate(self.shape):
+            for j, el in enumerate(row):
+                global_i = i + self.shape_i
+                global_j = j + self.shape_j
+                if el and 0 <= global_i < M and 0 <= global_j < N:
+                    assert not ret[global_i][global_j]
+                    ret[global_i][global_j] = el
 
         return ret
 
     def _gravitate(self):
         for i in range(M):
-            if all(self._table[i]):
-                self._table = (
-                    [[0 for _ in range(N)]]
-                    + self._table[:i]
-                    + self._table[i+1:]
-                )
+            if all(self._table.row(i)):
+                self._table.shift_down(i)
+                self.lines += 1
 
     def step(self):
         self._gravitate()
@@ -113,7 +142,7 @@ class TetrisField:
 
             self._gravitate()
 
-            self.shape = random.choice(self.SHAPES)
+            self.shape = self.rng.choice(self.SHAPES)
             self.shape_i = 0
             self.shape_j = 3
         else:
@@ -128,7 +157,7 @@ class TetrisField:
 
                 self._gravitate()
 
-                self.shape = random.choice(self.SHAPES)
+                self.shape = self.rng.choice(self.SHAPES)
                 self.shape_i = 0
                 self.shape_j = 3
                 break
@@ -136,7 +165,7 @@ class TetrisField:
                 self.shape_i += 1
 
     def rotate(self):
-        rotated_shape = list(list(x) for x in zip(*self.shape))[::-1]
+        rotated_shape = ROTATED[self.shape]
         if self.check_fit(rotated_shape, self.shape_i, self.shape_j):
             self.shape = rotated_shape
 
@@ -149,7 +178,7 @@ class TetrisField:
             self.shape_j += 1
 
     def loss(self):
-        return any(self._table[3]) or any(self._table[2])
+        return any(self._table.row(2)) or any(self._table.row(3))
 
     def print(self):
         for row in self.table():
@@ -199,12 +228,129 @@ class TetrisField:
         )
 
     def emoji(self):
-        table = [[1] * N] + self.table() + [[1] * N]
+        # rows the falling shape covers are drawn separately, the rest of
+        # the board comes from the grid's rendered rows
+        lines = list(self._table.render(self.emoji_, border=1))
+        for i, row in enumerate(self.shape):
+            global_i = i + self.shape_i
+            if not (any(row) and 0 <= global_i < M):
+                continue
+            line = bytearray(self._table.row(global_i))
+            for j, el in enumerate(row):
+                global_j = j + self.shape_j
+                if el and 0 <= global_j < N:
+                    assert not line[global_j]
+                    line[global_j] = el
+            lines[global_i] = render_row(self.emoji_, line, border=1)
 
-        return '\n'.join(
-            [''.join(
-                [self.emoji_[1]]
-                + list(self.emoji_[el] for el in row)
-                + [self.emoji_[1]]
-            ) for row in table]
-        )
+        edge = self.emoji_[1] * (N + 2)
+        return '\n'.join([edge] + lines + [edge])
+
+
+def rotations(shapes):
+    ret = {}
+    for shape in shapes:
+        for _ in range(4):
+            ret[shape] = tuple(zip(*shape))[::-1]
+            shape = ret[shape]
+    return ret
+
+
+# every rotation of every shape, computed once and shared by all fields
+ROTATED = rotations(TetrisField.SHAPES)
+
+# every shape numbered, for the packed form of the field
+ALL_SHAPES = tuple(ROTATED)
+SHAPE_IDS = {shape: k for k, shape in enumerate(ALL_SHAPES)}
+
+
+class Tetris(StateMachine):
+    __slots__ = ('field', 'history', 'palette')
+
+    similar = {
+        'налево': ['лево', 'влево'],
+        'направо': ['право', 'вправо'],
+        'вниз': ['низ'],
+        'отмена': ['отменить', 'отмени'],
+    }
+
+    # the texts are in content/tetris.json
+    PACK = 'tetris'
+    # the texts it needs, with the values they're filled in with
+    TEXTS = {
+        'start': ('board',),
+        'lost': (),
+    }
+
+    # moves that can be taken back
+    UNDO_DEPTH = 5
+
+    PALETTES = TetrisField.PALETTES
+
+    def __init__(self, rng=None, palette='default'):
+        super().__init__(rng)
+        self.palette = palette
+
+    def start(self):
+        self.field = TetrisField(self.rng, self.palette)
+        self.history = History(self.UNDO_DEPTH)
+        return packs.get(self.PACK).text('start', board=(self.field.emoji(), ''))
+
+    def score(self):
+        return self.field.lines
+
+    @StateMachine.input({'плитки'})
+    def bw_emoji(self):
+        self.field.emoji_ = self.field.BW_EMOJI
+        return self.field.emoji()
+
+    @StateMachine.input({'налево'})
+    def left(self):
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost'))
+        self.history.push(self.field.pack())
+        self.field.left()
+        self.field.step()
+        return self.field.emoji()
+
+    @StateMachine.input({'направо'})
+    def right(self):
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost'))
+        self.history.push(self.field.pack())
+        self.field.right()
+        self.field.step()
+        return self.field.emoji()
+
+    @StateMachine.input({'вниз'})
+    def down(self):
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost'))
+        self.history.push(self.field.pack())
+        self.field.multistep()
+        return self.field.emoji()
+
+    @StateMachine.input({'поворот'})
+    def rotate(self):
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost'))
+        self.history.push(self.field.pack())
+        self.field.rotate()
+        self.field.step()
+        return self.field.emoji()
+
+    @StateMachine.input({'отмена'})
+    def undo(self):
+        snapshot = self.history.pop()
+        if snapshot is None:
+            return NOTHING_TO_UNDO
+        self.field.unpack(snapshot)
+        return self.field.emoji()
+
+    @StateMachine.input({'достаточно'})
+    @StateMachine.input({'выйти'})
+    def enough(self):
+        raise EndSession(GAME_OVER)
+
+
+packs.require(Tetris.PACK, Tetris.TEXTS)
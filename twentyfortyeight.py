@@ -1,35 +1,83 @@
 import random
 
+from grid import Grid
+from history import History
+from content import packs
+from statemachine import StateMachine, EndSession, GAME_OVER, NOTHING_TO_UNDO
+
 
 class TwentyFourtyEightField:
     N = 4
 
-    def __init__(self):
-        self._table = [[0 for _ in range(self.N)] for _ in range(self.N)]
+    EMOJI = ('*️⃣', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟', '#️⃣')
+    PALETTES = {'default': EMOJI}
+
+    __slots__ = ('rng', '_table', 'emoji_')
+
+    def __init__(self, rng=None, palette='default'):
+        self.rng = rng or random.Random()
+        self._table = Grid(self.N, self.N)
         self.spawn()
-        self.emoji_ = ['*️⃣', '1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟', '#️⃣']
+        self.emoji_ = self.PALETTES[palette]
+
+    # the packed form is just the board
+    def pack(self):
+        return bytes(self._table.cells)
+
+    def unpack(self, data):
+        self._table.load(data)
+
+    def palette(self):
+        return next(name for name, emoji in self.PALETTES.items() if emoji is self.emoji_)
+
+    def __getstate__(self):
+        return self.rng, self.palette(), self.pack()
+
+    def __setstate__(self, state):
+        self.rng, palette, data = state
+        self._table = Grid(self.N, self.N)
+        self.emoji_ = self.PALETTES[palette]
+        self.unpack(data)
 
     def free(self):
         for i in range(self.N):
             for j in range(self.N):
-                if not self._table[i][j]:
+                if not self._table.at(i, j):
                     yield i, j
 
     def random_space(self):
-        return random.choice(list(
+        return self.rng.choice(list(
             self.free()
         ))
 
     def loss(self):
-        return not self.free()
+        # a full board still has a move while two neighbours can merge
+        if any(self.free()):
+            return False
+        N = self.N
+        cells = self._table.cells
+        for i in range(N):
+            for j in range(N):
+                value = cells[i * N + j]
+                if j + 1 < N and cells[i * N + j + 1] == value:
+                    return False
+                if i + 1 < N and cells[(i + 1) * N + j] == value:
+                    return False
+        return True
 
     def win(self):
-        return any([11 in row for row in self._table])
+        return 11 in self._table.cells
+
+    def max_tile(self):
+        return 2 ** max(self._table.cells)
 
     def spawn(self):
-        n = random.choice([1, 2])
+        # a move that merged nothing may leave no room
+        if not any(self.free()):
+            return
+        n = self.rng.choice([1, 2])
         i, j = self.random_space()
-        self._table[i][j] = n
+        self._table.put(i, j, n)
 
 
     def collapse(self, l):
@@ -47,57 +95,137 @@ class TwentyFourtyEightField:
 
         return out_l + [0] * (self.N - len(out_l))
 
-    def up(self):
-        table = [[0 for _ in range(self.N)] for _ in range(self.N)]
-
+    def collapse_rows(self):
         for i in range(self.N):
-            for j in range(self.N):
-                table[j][i] = self._table[i][j]
-
-        for i in range(self.N):
-            table[i] = self.collapse(table[i])
-
-        for i in range(self.N):
-            for j in range(self.N):
-                self._table[i][j] = table[j][i]
+            self._table.set_row(i, bytes(self.collapse(self._table.row(i))))
 
+    def up(self):
+        self._table.transpose()
+        self.collapse_rows()
+        self._table.transpose()
         self.spawn()
 
     def down(self):
-        table = [[0 for _ in range(self.N)] for _ in range(self.N)]
-
-        for i in range(self.N):
-            for j in range(self.N):
-                table[j][i] = self._table[i][j]
-
-        for i in range(self.N):
-            table[i] = list(reversed(self.collapse(list(reversed(table[i])))))
-
-        for i in range(self.N):
-            for j in range(self.N):
-                self._table[i][j] = table[j][i]
-
+        self._table.transpose()
+        self._table.reverse()
+        self.collapse_rows()
+        self._table.reverse()
+        self._table.transpose()
         self.spawn()
 
     def left(self):
-        for i in range(self.N):
-            self._table[i] = self.collapse(self._table[i])
+        self.collapse_rows()
         self.spawn()
 
     def right(self):
-        for i in range(self.N):
-            self._table[i] = list(reversed(self.collapse(list(reversed(self._table[i])))))
+        self._table.reverse()
+        self.collapse_rows()
+        self._table.reverse()
         self.spawn()
 
+    def table(self):
+        return self._table.table()
+
     def print(self):
-        for row in self._table:
-            print(''.join(str(n) for n in row))
+        self._table.print()
 
     def emoji(self):
-        table = [[0 for _ in range(self.N)] for _ in range(self.N)]
+        return '\n'.join(self._table.render(self.emoji_))
 
-        for i in range(self.N):
-            for j in range(self.N):
-                table[i][j] = self.emoji_[self._table[i][j]]
 
-        return '\n'.join(''.join(e for e in row) for row in table)
+class TwentyFourtyEight(StateMachine):
+    __slots__ = ('field', 'history', 'palette')
+
+    similar = {
+        'налево': ['лево', 'влево'],
+        'направо': ['право', 'вправо'],
+        'вниз': ['низ'],
+        'вверх': ['верх'],
+        'отмена': ['отменить', 'отмени'],
+    }
+
+    # the texts are in content/2048.json
+    PACK = '2048'
+    # the texts it needs, with the values they're filled in with
+    TEXTS = {
+        'start': ('board',),
+        'lost': ('board',),
+        'won': ('board',),
+    }
+
+    # moves that can be taken back
+    UNDO_DEPTH = 5
+
+    PALETTES = TwentyFourtyEightField.PALETTES
+
+    def __init__(self, rng=None, palette='default'):
+        super().__init__(rng)
+        self.palette = palette
+
+    def start(self):
+        self.field = TwentyFourtyEightField(self.rng, self.palette)
+        self.history = History(self.UNDO_DEPTH)
+        return packs.get(self.PACK).text('start', board=(self.field.emoji(), ''))
+
+    def score(self):
+        return self.field.max_tile()
+
+    @StateMachine.input({'налево'})
+    def left(self):
+        self.history.push(self.field.pack())
+        self.field.left()
+        ret = f'{{{self.field.emoji()}}}{{}}'
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=(ret, '')))
+        elif self.field.win():
+            raise EndSession(packs.get(self.PACK).text('won', board=(ret, '')))
+        return ret
+
+    @StateMachine.input({'направо'})
+    def right(self):
+        self.history.push(self.field.pack())
+        self.field.right()
+        ret = f'{{{self.field.emoji()}}}{{}}'
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=(ret, '')))
+        elif self.field.win():
+            raise EndSession(packs.get(self.PACK).text('won', board=(ret, '')))
+        return ret
+
+    @StateMachine.input({'вверх'})
+    def up(self):
+        self.history.push(self.field.pack())
+        self.field.up()
+        ret = f'{{{self.field.emoji()}}}{{}}'
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=(ret, '')))
+        elif self.field.win():
+            raise EndSession(packs.get(self.PACK).text('won', board=(ret, '')))
+        return ret
+
+    @StateMachine.input({'вниз'})
+    def down(self):
+        self.history.push(self.field.pack())
+        self.field.down()
+        ret = f'{{{self.field.emoji()}}}{{}}'
+        if self.field.loss():
+            raise EndSession(packs.get(self.PACK).text('lost', board=(ret, '')))
+        elif self.field.win():
+            raise EndSession(packs.get(self.PACK).text('won', board=(ret, '')))
+        return ret
+
+    @StateMachine.input({'отмена'})
+    def undo(self):
+        snapshot = self.history.pop()
+        if snapshot is None:
+            return NOTHING_TO_UNDO
+        self.field.unpack(snapshot)
+        return f'{{{self.field.emoji()}}}{{}}'
+
+    @StateMachine.input({'достаточно'})
+    @StateMachine.input({'выйти'})
+    def enough(self):
+        raise EndSession(GAME_OVER)
+
+
+packs.require(TwentyFourtyEight.PACK, TwentyFourtyEight.TEXTS)